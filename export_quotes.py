@@ -0,0 +1,12 @@
+import sys
+
+from portfolio.managers import QuotesManager
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else QuotesManager.archive_path
+    if not path:
+        raise ValueError('archive path is not set')
+    archive = QuotesManager.export(path)
+    print(f'{len(archive.index)} instruments, {len(archive.dates)} days '
+          f'written to {path}')
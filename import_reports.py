@@ -0,0 +1,19 @@
+import os
+import sys
+
+from portfolio.importer import import_reports
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise ValueError('reports directory is not set')
+    directory = sys.argv[1]
+    portfolio = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    paths = sorted(os.path.join(directory, name)
+                   for name in os.listdir(directory)
+                   if name.lower().endswith('.xml'))
+    reports, items = import_reports(paths, portfolio, test=False)
+    for report in reports:
+        print(f'{report.name}: broker {report.broker}, {report.count} records')
+    print(f'{len(reports)} of {len(paths)} reports imported, '
+          f'{len(items)} new records')
@@ -0,0 +1,11 @@
+import sys
+
+from portfolio.managers import QuoteBucketsManager
+
+
+if __name__ == '__main__':
+    size = sys.argv[1] if len(sys.argv) > 1 else QuoteBucketsManager.MONTH
+    if size not in QuoteBucketsManager.SIZES:
+        raise ValueError(size)
+    count = QuoteBucketsManager.migrate(size)
+    print(f'{count} {size} buckets written, set QUOTES_BUCKETS = {size!r}')
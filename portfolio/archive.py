@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+from collections.abc import ItemsView, KeysView, Mapping, ValuesView
+from datetime import date
+
+import numpy as np
+
+from portfolio.base import key_to_ordinal, ordinal_to_key
+
+
+class ReversibleKeys(KeysView):
+    def __reversed__(self):
+        yield from reversed(self._mapping)
+
+
+class ReversibleValues(ValuesView):
+    def __reversed__(self):
+        for key in reversed(self._mapping):
+            yield self._mapping[key]
+
+
+class ReversibleItems(ItemsView):
+    def __reversed__(self):
+        for key in reversed(self._mapping):
+            yield key, self._mapping[key]
+
+
+class ArchiveQuotes(Mapping):
+    # read-only day key -> price mapping over a slice of an archive column,
+    # the days without quotes hold nan
+    def __init__(self, prices, start, extra=None):
+        self.prices = prices
+        self.start = start
+        self.extra = extra or {}
+
+    def _get_row(self, key):
+        row = key_to_ordinal(key) - self.start
+        if 0 <= row < len(self.prices) and not np.isnan(self.prices[row]):
+            return row
+        return None
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        row = self._get_row(key)
+        if row is None:
+            raise KeyError(key)
+        return float(self.prices[row])
+
+    def __contains__(self, key):
+        return key in self.extra or self._get_row(key) is not None
+
+    def __iter__(self):
+        for row in np.flatnonzero(~np.isnan(self.prices)):
+            key = ordinal_to_key(self.start + int(row))
+            if key not in self.extra:
+                yield key
+        yield from self.extra
+
+    def __reversed__(self):
+        # the extra days follow the archived ones
+        yield from reversed(list(self.extra))
+        for row in np.flatnonzero(~np.isnan(self.prices))[::-1]:
+            key = ordinal_to_key(self.start + int(row))
+            if key not in self.extra:
+                yield key
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.prices))) + len(
+            [key for key in self.extra if self._get_row(key) is None])
+
+    # ordered by day like the dicts of the database reads
+    def keys(self):
+        return ReversibleKeys(self)
+
+    def values(self):
+        return ReversibleValues(self)
+
+    def items(self):
+        return ReversibleItems(self)
+
+    def take(self, dates):
+        # prices of the consecutive day keys, nan for the days without quotes
+        start = key_to_ordinal(dates[0]) - self.start if dates else 0
+        prices = np.full(len(dates), np.nan)
+        left = max(start, 0)
+        right = min(start + len(dates), len(self.prices))
+        if left < right:
+            prices[left - start:right - start] = self.prices[left:right]
+        for row, key in enumerate(dates):
+            if key in self.extra:
+                prices[row] = self.extra[key]
+        return prices
+
+
+class QuoteArchive:
+    # daily quotes exported to a directory of memory-mapped arrays: the
+    # shared axis of consecutive days, the (days, instruments) prices matrix
+    # stored column-major and the isin -> column index
+    DATES = 'dates.npy'
+    PRICES = 'prices.npy'
+    INDEX = 'index.json'
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.INDEX)) as f:
+            self.index = json.load(f)['isins']
+        self.dates = np.load(os.path.join(path, self.DATES), mmap_mode='r')
+        self.prices = np.load(os.path.join(path, self.PRICES), mmap_mode='r')
+        self.start = date.fromisoformat(str(self.dates[0])).toordinal()
+        self.end = self.start + len(self.dates) - 1
+
+    def covers(self, isin, time_range):
+        # the history is exported from the first quote, the ranges starting
+        # before the archive may have quotes loaded later
+        if isin.upper() not in self.index:
+            return False
+        if (time_range.start is not None and
+                key_to_ordinal(time_range.start) < self.start):
+            return False
+        return (time_range.end is not None and
+                key_to_ordinal(time_range.end) <= self.end)
+
+    def get_quotes(self, isin, time_range, extra=None):
+        column = self.prices[:, self.index[isin.upper()]]
+        left = 0
+        if time_range.start is not None:
+            left = max(key_to_ordinal(time_range.start) - self.start, 0)
+        right = key_to_ordinal(time_range.end) - self.start + 1
+        return ArchiveQuotes(column[left:max(right, left)],
+                             self.start + left, extra)
+
+    @classmethod
+    def write(cls, path, quotes):
+        quotes = {isin.upper(): data for isin, data in quotes.items() if data}
+        if not quotes:
+            raise ValueError('no quotes to export')
+        start = min(key_to_ordinal(next(iter(data)))
+                    for data in quotes.values())
+        end = max(key_to_ordinal(next(reversed(data)))
+                  for data in quotes.values())
+        isins = sorted(quotes)
+
+        # written next to the archive and swapped in, the processes reading
+        # the old files keep their mapped pages
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        dates = np.arange(date.fromordinal(start),
+                          date.fromordinal(end + 1), dtype='datetime64[D]')
+        np.save(os.path.join(tmp_path, cls.DATES), dates)
+        prices = np.lib.format.open_memmap(
+            os.path.join(tmp_path, cls.PRICES), mode='w+', dtype=np.float64,
+            shape=(len(dates), len(isins)), fortran_order=True)
+        prices[:] = np.nan
+        for column, isin in enumerate(isins):
+            data = quotes[isin]
+            rows = np.fromiter((key_to_ordinal(key) - start for key in data),
+                               dtype=np.int64, count=len(data))
+            prices[rows, column] = np.fromiter(data.values(),
+                                               dtype=np.float64,
+                                               count=len(data))
+        prices.flush()
+        del prices
+        with open(os.path.join(tmp_path, cls.INDEX), 'w') as f:
+            json.dump({'isins': {isin: column
+                                 for column, isin in enumerate(isins)}}, f)
+
+        old_path = path + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        return cls(path)
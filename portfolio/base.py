@@ -1,19 +1,58 @@
-from datetime import datetime
-from pymongo import MongoClient, ASCENDING, DESCENDING
+import threading
+import time
+from datetime import date, datetime
 
-from portfolio.config import MONGO_URL
+import numpy as np
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING
+
+from portfolio.config import (
+    DB_BACKEND, GENERATIONS_TTL, MONGO_URL, SQLITE_PATH)
+from portfolio.storage import MemoryClient, SqliteClient
 
 
 _CLIENT = None
+# collection -> write generation, kept in the database for all the processes
+# and read from it again after GENERATIONS_TTL or a local write
+_GENERATIONS = {}
+_GENERATIONS_READ = None
+_GENERATIONS_LOCK = threading.Lock()
+GENERATIONS = 'generations'
 
 
 def get_client():
     global _CLIENT
     if not _CLIENT:
-        _CLIENT = MongoClient(MONGO_URL)
+        if DB_BACKEND == 'memory':
+            _CLIENT = MemoryClient()
+        elif DB_BACKEND == 'sqlite':
+            _CLIENT = SqliteClient(SQLITE_PATH)
+        else:
+            _CLIENT = MongoClient(MONGO_URL)
     return _CLIENT
 
 
+def get_generations():
+    global _GENERATIONS, _GENERATIONS_READ
+    now = time.monotonic()
+    with _GENERATIONS_LOCK:
+        if (_GENERATIONS_READ is None or
+                now - _GENERATIONS_READ > GENERATIONS_TTL):
+            db = get_client().market
+            _GENERATIONS = {row['collection']: row['generation'] for row in
+                            db[GENERATIONS].find({}, {'_id': 0})}
+            _GENERATIONS_READ = now
+        return _GENERATIONS
+
+
+def bump_generation(collection):
+    global _GENERATIONS_READ
+    db = get_client().market
+    db[GENERATIONS].update({'collection': collection},
+                           {'$inc': {'generation': 1}}, upsert=True)
+    with _GENERATIONS_LOCK:
+        _GENERATIONS_READ = None
+
+
 def date_to_key(date):
     return date.year, date.month, date.day
 
@@ -22,6 +61,14 @@ def key_to_date(date):
     return datetime(date[0], date[1], date[2])
 
 
+def key_to_ordinal(key):
+    return date(*key).toordinal()
+
+
+def ordinal_to_key(ordinal):
+    return date_to_key(date.fromordinal(ordinal))
+
+
 def sround(s):
     return round(s, 2)
 
@@ -39,20 +86,45 @@ class Value:
         return value
 
 
-class ValueList(list):
-    def __init__(self, title):
-        super(ValueList, self).__init__()
-        self.i = 0
+class ValueList:
+    def __init__(self, title, index=None, data=None):
         self.title = title
         self._min = None
         self._max = None
+        if index is None:
+            self._index = np.empty(16, dtype=np.int32)
+            self._data = np.empty(16, dtype=np.float64)
+            self._size = 0
+        else:
+            self._index = np.ascontiguousarray(index, dtype=np.int32)
+            self._data = np.ascontiguousarray(data, dtype=np.float64)
+            assert self._index.shape == self._data.shape
+            self._size = len(self._index)
+            if self._size:
+                self._min = float(np.fmin.reduce(self._data))
+                self._max = float(np.fmax.reduce(self._data))
+
+    @property
+    def index(self):
+        return self._index[:self._size]
+
+    @property
+    def data(self):
+        return self._data[:self._size]
 
     def append(self, object):
         if self._min is None or object.value < self._min:
             self._min = object.value
         if self._max is None or object.value > self._max:
             self._max = object.value
-        super().append(object)
+
+        if self._size == len(self._index):
+            capacity = max(2 * self._size, 16)
+            self._index = np.resize(self._index, capacity)
+            self._data = np.resize(self._data, capacity)
+        self._index[self._size] = key_to_ordinal(object.key)
+        self._data[self._size] = object.value
+        self._size += 1
 
     @property
     def min(self):
@@ -62,89 +134,145 @@ class ValueList(list):
     def max(self):
         return self._max
 
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return ValueList(self.title, self.index[item], self.data[item])
+        value = Value()
+        value.key = ordinal_to_key(int(self.index[item]))
+        value.value = float(self.data[item])
+        return value
+
+    def __iter__(self):
+        for ordinal, data in zip(self.index.tolist(), self.data.tolist()):
+            value = Value()
+            value.key = ordinal_to_key(ordinal)
+            value.value = data
+            yield value
+
+    def __array__(self, dtype=None, copy=None):
+        return self.data.astype(dtype) if dtype else self.data
+
+    def copy(self, title=None):
+        return ValueList(title or self.title, self.index.copy(),
+                         self.data.copy())
+
+    def _align(self, other):
+        # pairs the values like zip, the keys must match
+        size = min(self._size, len(other))
+        index = self.index[:size]
+        if not np.array_equal(index, other.index[:size]):
+            raise ValueError('inconsistent lists')
+        return index, self.data[:size], other.data[:size]
+
     def __add__(self, other):
         assert isinstance(other, ValueList)
-        result = ValueList(f'{self.title}+{other.title}')
+        title = f'{self.title}+{other.title}'
         if not other:
-            for item in self:
-                result.append(item.copy())
-
-        for item1, item2 in zip(self, other):
-            if item1.key != item2.key:
-                raise ValueError('inconsistent lists')
-            value = Value()
-            value.key = item1.key
-            value.value = item1.value + item2.value
-            result.append(value)
-        return result
+            return self.copy(title)
+        index, data1, data2 = self._align(other)
+        return ValueList(title, index, data1 + data2)
 
     def __sub__(self, other):
         assert isinstance(other, ValueList)
-        result = ValueList(f'{self.title}-{other.title}')
+        title = f'{self.title}-{other.title}'
         if not other:
-            for item in self:
-                result.append(item.copy())
-
-        for item1, item2 in zip(self, other):
-            if item1.key != item2.key:
-                raise ValueError('inconsistent lists')
-            value = Value()
-            value.key = item1.key
-            value.value = item1.value - item2.value
-            result.append(value)
-        return result
+            return self.copy(title)
+        index, data1, data2 = self._align(other)
+        return ValueList(title, index, data1 - data2)
 
     def __truediv__(self, other):
         assert isinstance(other, ValueList)
-        result = ValueList(f'{self.title}/{other.title}')
+        title = f'{self.title}/{other.title}'
         if not other:
-            for item in self:
-                result.append(item.copy())
-
-        for item1, item2 in zip(self, other):
-            if item1.key != item2.key:
-                raise ValueError('inconsistent lists')
-            value = Value()
-            value.key = item1.key
-            value.value = sround(item1.value / item2.value)
-            result.append(value)
-        return result
+            return self.copy(title)
+        index, data1, data2 = self._align(other)
+        if not data2.all():
+            raise ZeroDivisionError('float division by zero')
+        data = np.divide(data1, data2)
+        return ValueList(title, index, np.round(data, 2, out=data))
 
     def __rmul__(self, other):
         assert isinstance(other, (int, float))
-        result = ValueList(f'{other}*{self.title}')
-        for item1 in self:
-            value = Value()
-            value.key = item1.key
-            value.value = other * item1.value
-            result.append(value)
-        return result
+        return ValueList(f'{other}*{self.title}', self.index,
+                         other * self.data)
 
     def keys(self):
-        for i in range(len(self)):
-            yield key_to_date(self[i].key)
+        for ordinal in self.index.tolist():
+            yield key_to_date(ordinal_to_key(ordinal))
 
     def values(self):
-        for i in range(len(self)):
-            yield self[i].value
+        yield from self.data.tolist()
 
 
 class TimeRange:
     def __init__(self, start_time, end_time):
         if start_time:
             assert isinstance(start_time, datetime)
-            start_time = start_time.replace(hour=0, minute=0, second=0)
+            start_time = start_time.replace(hour=0, minute=0, second=0,
+                                            microsecond=0)
         if end_time:
             assert isinstance(end_time, datetime)
-            end_time = end_time.replace(hour=23, minute=59, second=59)
+            end_time = end_time.replace(hour=23, minute=59, second=59,
+                                        microsecond=999999)
         self.start_time = start_time
         self.end_time = end_time
         self.start = date_to_key(start_time) if start_time else None
         self.end = date_to_key(end_time) if end_time else None
 
+    def __eq__(self, other):
+        return (isinstance(other, TimeRange) and self.start == other.start and
+                self.end == other.end)
+
+    def __hash__(self):
+        return hash((self.start, self.end))
+
 
 class DBManager:
     collection = model = None
+    # indexes as lists of fields or (field, direction) tuples and the shapes
+    # of the queries the manager issues, as get() arguments, to audit them
+    indexes = ()
+    queries = ()
+    # the writes bump the generation of the collection, set for the managers
+    # with reads cached on it
+    generations = False
+
+    @staticmethod
+    def _get_sort(sort):
+        if sort and not isinstance(sort, list):
+            sort = [sort]
+        return [
+            (field[0], ASCENDING if field[1] >= 0 else DESCENDING)
+            if isinstance(field, tuple) else (field, ASCENDING)
+            for field in sort or ()]
+
+    @classmethod
+    def ensure_indexes(cls):
+        client = get_client()
+        db = client.market
+        return [db[cls.collection].create_index(cls._get_sort(list(index)))
+                for index in cls.indexes]
+
+    @classmethod
+    def explain(cls, **kwargs):
+        return cls.get(**kwargs).explain()
+
+    @classmethod
+    def audit(cls):
+        # the stages of the winning plans, COLLSCAN means no index is used
+        result = []
+        for query in cls.queries:
+            plan = cls.explain(**dict(query))['queryPlanner']['winningPlan']
+            stages = []
+            while plan:
+                stages.append(plan.get('stage'))
+                plan = plan.get('inputStage') or (plan.get('inputStages') or
+                                                  [None])[0]
+            result.append((query, stages))
+        return result
 
     @classmethod
     def upsert(cls, key, data=None):
@@ -156,6 +284,8 @@ class DBManager:
         db = client.market
         response = db[cls.collection].update(key, {'$set': data},
                                              upsert=True)
+        cls.bump()
+        cls.changed([data])
         return response
 
     @classmethod
@@ -172,12 +302,86 @@ class DBManager:
                 if not hasattr(cls.model, key):
                     raise ValueError(f'unknown field {key}')
             db[cls.collection].insert_many(data)
+        cls.bump()
+        cls.changed([data] if isinstance(data, dict) else data)
+
+    @classmethod
+    def bulk_upsert(cls, keys, data):
+        assert len(keys) == len(data)
+        if not data:
+            return None
+        client = get_client()
+        db = client.market
+        response = db[cls.collection].bulk_write([
+            UpdateOne(key, {'$set': item}, upsert=True)
+            for key, item in zip(keys, data)], ordered=False)
+        cls.bump()
+        cls.changed(data)
+        return response
+
+    @classmethod
+    def append(cls, key, arrays, data=None):
+        # pushes the values to the array fields of the matched document,
+        # returns the number of the matched documents
+        assert isinstance(key, dict)
+        update = {'$push': {field: {'$each': list(values)}
+                            for field, values in arrays.items()}}
+        if data:
+            update['$set'] = data
+
+        client = get_client()
+        db = client.market
+        response = db[cls.collection].update(key, update)
+        cls.bump()
+        return response['n']
+
+    @classmethod
+    def get_generation(cls):
+        return get_generations().get(cls.collection, 0)
+
+    @classmethod
+    def bump(cls):
+        # a write starts a new generation of the collection when its reads
+        # are cached on it
+        if cls.generations:
+            bump_generation(cls.collection)
+
+    @classmethod
+    def changed(cls, data):
+        pass
 
     @classmethod
     def clear(cls):
         client = get_client()
         db = client.market
         db[cls.collection].drop()
+        cls.bump()
+
+    @classmethod
+    def delete(cls, **kwargs):
+        kwargs = cls._get_filters(kwargs)
+        client = get_client()
+        db = client.market
+        response = db[cls.collection].delete_many(kwargs)
+        cls.bump()
+        return response
+
+    @staticmethod
+    def can_aggregate():
+        return isinstance(get_client(), MongoClient)
+
+    @classmethod
+    def aggregate(cls, pipeline):
+        client = get_client()
+        db = client.market
+        return list(db[cls.collection].aggregate(pipeline))
+
+    @classmethod
+    def distinct(cls, field, **kwargs):
+        kwargs = cls._get_filters(kwargs)
+        client = get_client()
+        db = client.market
+        return db[cls.collection].distinct(field, kwargs)
 
     @classmethod
     def get_first(cls, **kwargs):
@@ -185,10 +389,7 @@ class DBManager:
         return cls.get(**kwargs)
 
     @classmethod
-    def get(cls, **kwargs):
-        sort = kwargs.pop('sort', None)
-        first = kwargs.pop('first', False)
-        fields = kwargs.pop('fields', {})
+    def _get_filters(cls, kwargs):
         for key in list(kwargs.keys()):
             value = kwargs[key]
             if isinstance(value, TimeRange):
@@ -201,9 +402,14 @@ class DBManager:
                     kwargs[key] = {'$lte': value.end_time}
                 else:
                     kwargs.pop(key)
+        return kwargs
 
-        if sort and not isinstance(sort, list):
-            sort = [sort]
+    @classmethod
+    def get(cls, **kwargs):
+        sort = kwargs.pop('sort', None)
+        first = kwargs.pop('first', False)
+        fields = kwargs.pop('fields', {})
+        kwargs = cls._get_filters(kwargs)
 
         client = get_client()
         db = client.market
@@ -215,8 +421,5 @@ class DBManager:
             else:
                 response = db[cls.collection].find(kwargs)
         if sort:
-            response = response.sort([
-                (field[0], ASCENDING if field[1] >= 0 else DESCENDING)
-                if isinstance(field, tuple) else (field, ASCENDING)
-                for field in sort])
+            response = response.sort(cls._get_sort(sort))
         return response
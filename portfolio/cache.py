@@ -0,0 +1,189 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from types import MappingProxyType
+
+import numpy as np
+
+from portfolio.base import date_to_key, key_to_ordinal
+from portfolio.config import (
+    GENERATION_CACHE_SIZE, QUOTE_CACHE_BUDGET, QUOTE_CACHE_TTL)
+
+
+class QuoteCacheEntry:
+    __slots__ = ('keys', 'prices', 'intervals', 'checked', 'views', 'size')
+
+    MAX_VIEWS = 8
+
+    def __init__(self):
+        self.keys = []
+        self.prices = []
+        # merged (start, end) day ordinals that were loaded, including the
+        # days without candles
+        self.intervals = []
+        self.checked = 0
+        self.views = OrderedDict()
+        self.size = 0
+
+    def covers(self, start, end):
+        start = key_to_ordinal(start)
+        end = key_to_ordinal(end)
+        for interval_start, interval_end in self.intervals:
+            if interval_start <= start and end <= interval_end:
+                return True
+        return False
+
+    def get(self, start, end, today=None, price=None):
+        view_key = start, end, today, price
+        view = self.views.get(view_key)
+        if view is None:
+            left = bisect_left(self.keys, start)
+            right = bisect_right(self.keys, end)
+            view = OrderedDict(zip(self.keys[left:right],
+                                   self.prices[left:right]))
+            if today is not None:
+                view[today] = price
+            # shared by the callers, they get a read-only proxy
+            view = MappingProxyType(view)
+            self.views[view_key] = view
+            self.size += len(view)
+            if len(self.views) > self.MAX_VIEWS:
+                self.size -= len(self.views.popitem(last=False)[1])
+        else:
+            self.views.move_to_end(view_key)
+        return view
+
+    def add(self, start, end, quotes):
+        data = dict(zip(self.keys, self.prices))
+        data.update(quotes)
+        self.keys = sorted(data)
+        self.prices = [data[key] for key in self.keys]
+        self.views.clear()
+        self.size = len(self.keys)
+
+        intervals = self.intervals + [(key_to_ordinal(start),
+                                       key_to_ordinal(end))]
+        intervals.sort()
+        self.intervals = [intervals[0]]
+        for interval_start, interval_end in intervals[1:]:
+            last_start, last_end = self.intervals[-1]
+            if interval_start <= last_end + 1:
+                self.intervals[-1] = last_start, max(last_end, interval_end)
+            else:
+                self.intervals.append((interval_start, interval_end))
+
+
+class QuoteCache:
+    # rough memory taken by one cached quote: the key tuple, the float and
+    # the slots in the lists and views referencing them
+    ITEM_SIZE = 200
+
+    def __init__(self, budget=QUOTE_CACHE_BUDGET, ttl=QUOTE_CACHE_TTL):
+        self.budget = budget
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.generation = None
+
+    @property
+    def size(self):
+        return self.ITEM_SIZE * self._size
+
+    def _is_fresh(self, entry, end):
+        # the latest days may still get their candles, ranges ending there
+        # are served from the cache for ttl seconds only
+        recent = date_to_key(datetime.now() - timedelta(days=1))
+        return end < recent or time.monotonic() - entry.checked < self.ttl
+
+    def sync(self, generation):
+        # the quotes were written since the entries were loaded
+        with self._lock:
+            if generation != self.generation:
+                self.clear()
+                self.generation = generation
+
+    def get(self, isin, start, end, today=None, price=None):
+        with self._lock:
+            entry = self._entries.get(isin)
+            if entry is None or not entry.covers(start, end):
+                return None
+            if not self._is_fresh(entry, end):
+                return None
+            self._entries.move_to_end(isin)
+            size = entry.size
+            view = entry.get(start, end, today, price)
+            if entry.size != size:
+                self._size += entry.size - size
+                self._evict()
+            return view
+
+    def put(self, isin, start, end, quotes):
+        with self._lock:
+            entry = self._entries.get(isin)
+            if entry is None:
+                entry = self._entries[isin] = QuoteCacheEntry()
+            size = entry.size
+            entry.add(start, end, quotes)
+            self._size += entry.size - size
+            entry.checked = time.monotonic()
+            self._entries.move_to_end(isin)
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > 1 and self.size > self.budget:
+            self._size -= self._entries.popitem(last=False)[1].size
+
+    def clear(self, isin=None):
+        with self._lock:
+            if isin is None:
+                self._entries.clear()
+                self._size = 0
+            else:
+                entry = self._entries.pop(isin, None)
+                if entry is not None:
+                    self._size -= entry.size
+
+
+def freeze(value):
+    # the cached results are shared by the callers, the lists become tuples,
+    # the dicts read-only proxies and the arrays read-only
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item)
+                                 for key, item in value.items()})
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    return value
+
+
+def generation_cache(maxsize=GENERATION_CACHE_SIZE):
+    # lru cache of a DBManager classmethod keyed on the generation of its
+    # collection, the entries of the older generations are never hit again
+    # and fall out of the lru
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            key = (cls, cls.get_generation(), args,
+                   tuple(sorted(kwargs.items())))
+            with lock:
+                if key in cache:
+                    cache.move_to_end(key)
+                    return cache[key]
+            result = freeze(func(cls, *args, **kwargs))
+            with lock:
+                cache[key] = result
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
@@ -1,3 +1,7 @@
+import os
+import tempfile
+from datetime import timedelta
+
 from portfolio.secret import *
 
 API_URL = 'https://api-invest.tinkoff.ru/openapi/sandbox'
@@ -14,3 +18,99 @@ CBR_RATE = {
 }
 
 MONGO_URL = 'mongodb://localhost:27017/'
+
+# 'mongo', or the embedded 'memory' and 'sqlite' storages for single user
+# setups and tests
+DB_BACKEND = 'mongo'
+SQLITE_PATH = 'portfolio.sqlite3'
+
+# days before today that are never stored in snapshots, the latest candles
+# may still be missing or change for them
+SNAPSHOT_DELAY = 3
+
+# memory budget of the in-process quote cache in bytes, how long ranges
+# ending at the latest days are served from it
+QUOTE_CACHE_BUDGET = 64 * 1024 * 1024
+QUOTE_CACHE_TTL = 15 * 60
+
+# seconds a live price is fresh while the instrument is trading and while it
+# is not, seconds an expired price is still served while it is reloaded, and
+# threads loading the live prices
+PRICES_TTL = 30
+PRICES_CLOSED_TTL = 15 * 60
+PRICES_STALE = 5 * 60
+PRICES_WORKERS = 8
+
+# reads of the ledger collections cached until the next write to them
+GENERATION_CACHE_SIZE = 256
+
+# seconds the write generations of the collections are trusted before they are
+# read again, the writes of the other processes are seen after it
+GENERATIONS_TTL = 1
+
+# threads loading quotes of the portfolio instruments before valuation
+QUOTE_PREFETCH_WORKERS = 8
+
+# connection pool size, (connect, read) timeouts in seconds, retries with
+# their backoff base in seconds and parallel requests of each upstream
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = (3.05, 10)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_CONCURRENCY = 4
+
+# days after which missing candles are not requested again
+QUOTES_FINAL_DELAY = 2
+
+# longest gap between the stored days of the quotes loaded before the coverage
+# was tracked that is taken for weekends and holidays
+QUOTES_COVERAGE_GAP = timedelta(days=4)
+
+# layout of the stored daily quotes: None for one document per quote, 'month'
+# or 'year' for the buckets built by migrate_quotes.py
+QUOTES_BUCKETS = None
+
+# directory of the quotes archive written by export_quotes.py, the quotes are
+# read from it instead of the database when set
+QUOTES_ARCHIVE = None
+
+# age of the local instruments catalog after which an unknown instrument
+# triggers a reload of the whole catalog
+SECURITIES_TTL = timedelta(days=1)
+
+# delay before an instrument missing in the fresh catalog is requested again
+SECURITIES_LOOKUP_DELAY = timedelta(hours=1)
+
+# start the background quotes refresher with the web app, seconds between
+# the live price reloads of the trading and not trading instruments, between
+# the reloads of the current day candles and of the held instruments list
+REFRESHER = False
+REFRESH_INTERVAL = 15
+REFRESH_CLOSED_INTERVAL = 5 * 60
+REFRESH_CANDLES_INTERVAL = 5 * 60
+REFRESH_HOLDINGS_INTERVAL = 10 * 60
+
+# parsed report records written to the database at once
+PARSER_BATCH_SIZE = 1000
+
+# seconds between the progress updates of a report being parsed
+PARSER_PROGRESS_INTERVAL = 0.5
+
+# new records of a parsed report kept to be shown by each model
+REPORT_PREVIEW_SIZE = 1000
+
+# the uploaded reports waiting for their jobs
+REPORT_UPLOAD_DIR = os.path.join(tempfile.gettempdir(), 'portfolio-reports')
+
+# distinct report dates parsed by each date field kept in memory
+PARSER_DATE_CACHE_SIZE = 4096
+
+# processes parsing the report files of an import
+IMPORT_WORKERS = 4
+
+# threads running the background jobs of the web app
+JOB_WORKERS = 2
+
+# queued or running jobs not updated for this long are lost with their
+# process and marked failed, their uploaded files removed
+JOB_TIMEOUT = timedelta(minutes=30)
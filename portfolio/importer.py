@@ -0,0 +1,92 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+from portfolio.config import IMPORT_WORKERS
+from portfolio.managers import (
+    ReportsManager, SecuritiesManager, SnapshotManager)
+from portfolio.parsers import PARSERS, detect_broker
+
+
+def get_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(manager, data):
+    # the same record of overlapping reports has the same fingerprint
+    return manager.collection, tuple(sorted(data.items()))
+
+
+def init_worker(refresh):
+    SecuritiesManager.auto_refresh = refresh
+
+
+def read_report(path, portfolio):
+    # runs in the pool, returns the broker and the records of the report
+    with open(path, 'rb') as f:
+        broker = detect_broker(f)
+        f.seek(0)
+        return broker, list(PARSERS[broker](portfolio).iter_items(f))
+
+
+def import_reports(paths, portfolio=1, test=False, workers=IMPORT_WORKERS):
+    # parses the new report files in parallel and writes their records with
+    # one bulk upsert per collection, returns the imported reports and the
+    # new items
+    hashes = {}
+    for path in paths:
+        hashes.setdefault(get_hash(path), path)
+    known = ReportsManager.get_hashes(hashes)
+    hashes = {hash: path for hash, path in hashes.items() if hash not in known}
+    if not hashes:
+        return [], []
+
+    # the catalog of instruments is reloaded once here instead of by each
+    # of the workers
+    if SecuritiesManager.is_stale():
+        SecuritiesManager.refresh()
+
+    parsers = {}
+    reports = []
+    seen = set()
+    # the workers are spawned, the forked ones would share the database
+    # connections of this process
+    with ProcessPoolExecutor(min(workers, len(hashes)),
+                             mp_context=get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(False, )) as executor:
+        futures = {hash: executor.submit(read_report, path, portfolio)
+                   for hash, path in hashes.items()}
+        for hash, future in futures.items():
+            broker, items = future.result()
+            parser = parsers.get(broker)
+            if parser is None:
+                parser = parsers[broker] = PARSERS[broker](portfolio)
+            for manager, data in items:
+                key = fingerprint(manager, data)
+                if key not in seen:
+                    seen.add(key)
+                    parser.add(manager, data)
+            reports.append({
+                'hash': hash,
+                'name': os.path.basename(hashes[hash]),
+                'broker': broker,
+                'portfolio': portfolio,
+                'date': datetime.now(),
+                'count': len(items),
+            })
+
+    new = []
+    with SnapshotManager.deferred():
+        for parser in parsers.values():
+            new.extend(parser.commit(test))
+    imported = [ReportsManager.model(**report) for report in reports]
+    if not test:
+        ReportsManager.insert(reports)
+    return imported, new
@@ -0,0 +1,43 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from portfolio.config import JOB_WORKERS
+from portfolio.managers import JobsManager
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    # runs the jobs in the threads of this process, their state is kept in
+    # the jobs collection so the web workers sharing the database can report
+    # it. A job lost with its process is failed after JOB_TIMEOUT
+    def __init__(self, workers=JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='jobs')
+
+    def submit(self, kind, function, *args, **kwargs):
+        # the function takes a progress callback of the done share and
+        # returns the stored result
+        job = JobsManager.create(kind)
+        self._executor.submit(self._run, job, function, args, kwargs)
+        return job
+
+    @staticmethod
+    def _run(job, function, args, kwargs):
+        JobsManager.update(job, status=JobsManager.RUNNING)
+
+        def progress(share):
+            JobsManager.update(job, progress=share)
+
+        try:
+            result = function(*args, progress=progress, **kwargs)
+        except Exception as e:
+            logger.exception('Job %s failed', job)
+            JobsManager.update(job, status=JobsManager.FAILED,
+                               error=f'{type(e).__name__}: {e}')
+        else:
+            JobsManager.update(job, status=JobsManager.DONE, progress=1,
+                               result=result)
+
+
+job_queue = JobQueue()
@@ -0,0 +1,153 @@
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+
+from portfolio.base import TimeRange
+from portfolio.managers import (
+    Order, Money, Dividend, Commission, OrdersManager, MoneyManager,
+    DividendManager, CommissionManager)
+
+
+class Ledger:
+    # the order of the collections in the merged stream, events of the same
+    # day keep this order
+    MANAGERS = (MoneyManager, DividendManager, OrdersManager,
+                CommissionManager, )
+
+    def __init__(self, portfolio_id, broker_id=None, time_range=None,
+                 data=None, generations=None):
+        self.portfolio_id = portfolio_id
+        self.broker_id = broker_id
+        self.time_range = time_range or TimeRange(None, None)
+        if data is None:
+            self.generations = self.get_generations()
+            data = self._load()
+        else:
+            self.generations = generations
+        self.data = data
+        self._events = None
+        self._by_date = None
+
+    def _load(self):
+        with ThreadPoolExecutor(len(self.MANAGERS)) as executor:
+            futures = [
+                executor.submit(manager.get_data, self.portfolio_id,
+                                self.time_range, broker_id=self.broker_id)
+                for manager in self.MANAGERS]
+            return {manager.collection: future.result()
+                    for manager, future in zip(self.MANAGERS, futures)}
+
+    def get_generations(self):
+        return tuple(manager.get_generation() for manager in self.MANAGERS)
+
+    def is_current(self):
+        # nothing was written to the collections since the ledger was loaded
+        return self.generations == self.get_generations()
+
+    def get(self, manager):
+        return self.data[manager.collection]
+
+    @property
+    def money(self):
+        return self.get(MoneyManager)
+
+    @property
+    def orders(self):
+        return self.get(OrdersManager)
+
+    @property
+    def dividends(self):
+        return self.get(DividendManager)
+
+    @property
+    def commission(self):
+        return self.get(CommissionManager)
+
+    @property
+    def events(self):
+        if self._events is None:
+            self._events = list(heapq.merge(
+                *(self.get(manager) for manager in self.MANAGERS),
+                key=attrgetter('date')))
+        return self._events
+
+    def orders_isins(self):
+        return list(dict.fromkeys(order.isin for order in self.orders))
+
+    def by_date(self):
+        if self._by_date is None:
+            self._by_date = defaultdict(list)
+            for event in self.events:
+                self._by_date[event.date].append(event)
+        return self._by_date
+
+    def positions(self, date=None, portfolio=None):
+        portfolio = defaultdict(int, portfolio or {})
+        events = self.events
+        if date is not None:
+            events = events[:bisect_right(self.events, date,
+                                          key=attrgetter('date'))]
+        self.update_positions(portfolio, events)
+        return portfolio
+
+    def iter_positions(self, dates, portfolio=None):
+        portfolio = defaultdict(int, portfolio or {})
+        by_date = self.by_date()
+        for date in dates:
+            self.update_positions(portfolio, by_date.get(date, ()))
+            yield date, portfolio
+
+    @staticmethod
+    def update_positions(portfolio, events):
+        for event in events:
+            cur = event.cur
+            sum = event.sum
+            if isinstance(event, Order):
+                assert sum > 0
+                isin = event.isin
+                quantity = event.quantity
+                portfolio[isin] += quantity
+                portfolio[cur] -= quantity / abs(quantity) * sum
+            if isinstance(event, (Money, Dividend)):
+                portfolio[cur] += sum
+            if isinstance(event, Commission):
+                assert sum > 0
+                portfolio[cur] -= sum
+
+    def covers(self, time_range):
+        start, end = self.time_range.start, self.time_range.end
+        if start is not None and (time_range.start is None or
+                                  time_range.start < start):
+            return False
+        if end is not None and (time_range.end is None or
+                                time_range.end > end):
+            return False
+        return True
+
+    def union(self, time_range):
+        start_time = end_time = None
+        if self.time_range.start and time_range.start:
+            start_time = min(self.time_range.start_time,
+                             time_range.start_time)
+        if self.time_range.end and time_range.end:
+            end_time = max(self.time_range.end_time, time_range.end_time)
+        return TimeRange(start_time, end_time)
+
+    def slice(self, time_range):
+        if (time_range.start == self.time_range.start and
+                time_range.end == self.time_range.end):
+            return self
+        key = attrgetter('date')
+        data = {}
+        for collection, items in self.data.items():
+            left = 0
+            right = len(items)
+            if time_range.start is not None:
+                left = bisect_left(items, time_range.start, key=key)
+            if time_range.end is not None:
+                right = bisect_right(items, time_range.end, key=key)
+            data[collection] = items[left:right]
+        return Ledger(self.portfolio_id, self.broker_id, time_range,
+                      data=data, generations=self.generations)
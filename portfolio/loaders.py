@@ -1,27 +1,110 @@
-from datetime import datetime
+import random
+import threading
+import time
+from datetime import datetime, timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from portfolio.config import API_URL, API_TOKEN, ISS_API_URL
+from portfolio.base import TimeRange
+from portfolio.config import (
+    API_URL, API_TOKEN, ISS_API_URL, HTTP_POOL_SIZE, HTTP_TIMEOUT,
+    HTTP_RETRIES, HTTP_BACKOFF, HTTP_CONCURRENCY)
+
+
+class HttpClient:
+    RETRY_STATUSES = (429, 500, 502, 503, 504, )
+
+    def __init__(self, base_url, headers=None, pool_size=HTTP_POOL_SIZE,
+                 timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES,
+                 backoff=HTTP_BACKOFF, concurrency=HTTP_CONCURRENCY):
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # urllib3 pools are thread-safe, the adapter is shared by the
+        # per-thread sessions so all of them reuse the same connections
+        self._adapter = HTTPAdapter(pool_connections=1,
+                                    pool_maxsize=pool_size)
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers.update(self.headers)
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+        return session
+
+    def get(self, path, timeout=None, **kwargs):
+        timeout = timeout or self.timeout
+        attempt = 0
+        while True:
+            try:
+                with self._semaphore:
+                    response = self.session.get(self.base_url + path,
+                                                timeout=timeout, **kwargs)
+                if (response.status_code not in self.RETRY_STATUSES or
+                        attempt >= self.retries):
+                    response.raise_for_status()
+                    return response
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            attempt += 1
 
 
 class QuotesLoader:
+    api = HttpClient(API_URL, {'Authorization': f'Bearer {API_TOKEN}'})
+    iss = HttpClient(ISS_API_URL)
+
+    MIN1 = '1min'
+    MIN5 = '5min'
+    MIN15 = '15min'
+    HOUR = 'hour'
+    DAY = 'day'
+    WEEK = 'week'
+    MONTH = 'month'
+    # the longest range of candles the API returns at once, in days
+    MAX_RANGES = {
+        MIN1: 1,
+        MIN5: 1,
+        MIN15: 1,
+        HOUR: 7,
+        DAY: 365,
+        WEEK: 728,
+        MONTH: 3650,
+    }
+
     @classmethod
-    def history(cls, isin, time_range, interval='day'):
+    def get_chunks(cls, time_range, interval=DAY):
+        days = timedelta(days=cls.MAX_RANGES[interval])
+        start = time_range.start_time
+        while start <= time_range.end_time:
+            end = min(start + days - timedelta(days=1), time_range.end_time)
+            yield TimeRange(start, end)
+            start = start.replace(hour=0, minute=0, second=0) + days
+
+    @classmethod
+    def history(cls, isin, time_range, interval=DAY):
         from portfolio.managers import SecuritiesManager
         data = SecuritiesManager.get_data(isin=isin)
         figi = data['figi']
-        headers = {'Authorization': f'Bearer {API_TOKEN}'}
 
         frmt = '%Y-%m-%dT00:00:00.000000+03:00'
         from_time = time_range.start_time.strftime(frmt)
         frmt = '%Y-%m-%dT23:59:59.000000+03:00'
         to_time = time_range.end_time.strftime(frmt)
 
-        response = requests.get(
-            API_URL + '/market/candles',
+        response = cls.api.get(
+            '/market/candles',
             data={'figi': figi, 'from': from_time, 'to': to_time,
-                  'interval': interval}, headers=headers)
+                  'interval': interval})
 
         data_save = []
         for day in response.json()['payload']['candles']:
@@ -39,9 +122,9 @@ class QuotesLoader:
 
     @classmethod
     def _get_iss_data(cls, code):
-        url = f'{ISS_API_URL}/iss/engines/currency/markets/selt/' \
-              f'boards/CETS/securities/%s.json'
-        response = requests.get(url % code)
+        url = '/iss/engines/currency/markets/selt/boards/CETS/securities/' \
+              '%s.json'
+        response = cls.iss.get(url % code)
         data = response.json()['marketdata']
         last = data['data'][0][data['columns'].index('LAST')]
         status = data['data'][0][data['columns'].index('TRADINGSTATUS')]
@@ -53,21 +136,27 @@ class QuotesLoader:
         from portfolio.managers import SecuritiesManager
         data = SecuritiesManager.get_data(isin=isin)
         figi = data['figi']
-        headers = {'Authorization': f'Bearer {API_TOKEN}'}
 
-        response = requests.get(API_URL + '/market/orderbook',
-                                data={'figi': figi, 'depth': 0},
-                                headers=headers)
-        return response.json()['payload']['lastPrice']
+        response = cls.api.get('/market/orderbook',
+                               data={'figi': figi, 'depth': 0})
+        payload = response.json()['payload']
+        # status: NormalTrading, NotAvailableForTrading
+        return payload['lastPrice'], payload['tradeStatus'] == 'NormalTrading'
+
+    @classmethod
+    def get_instruments(cls):
+        instruments = []
+        for sec_type in ('stocks', 'bonds', 'etfs', 'currencies', ):
+            response = cls.api.get(f'/market/{sec_type}')
+            instruments.extend(response.json()['payload']['instruments'])
+        return instruments
 
     @classmethod
     def get_securities_data(cls, isin):
-        headers = {'Authorization': f'Bearer {API_TOKEN}'}
         securities = ('stocks', 'bonds', 'etfs', )
 
         for sec_type in securities:
-            response = requests.get(API_URL + f'/market/{sec_type}',
-                                    headers=headers)
+            response = cls.api.get(f'/market/{sec_type}')
             items = response.json()['payload']['instruments']
             for item in items:
                 if item['isin'] == isin:
@@ -75,6 +164,10 @@ class QuotesLoader:
 
     @classmethod
     def current(cls, isin):
+        return cls.current_status(isin)[0]
+
+    @classmethod
+    def current_status(cls, isin):
         currencies = {
             'USD': ('USD000000TOD', 'USD000UTSTOM', ),
             'EUR': ('EUR_RUB__TOD', 'EUR_RUB__TOM',),
@@ -84,5 +177,5 @@ class QuotesLoader:
             if not _active:
                 last, _active = cls._get_iss_data(currencies[isin][1])
         else:
-            last = cls._get_orderbook_data(isin)
-        return last
+            last, _active = cls._get_orderbook_data(isin)
+        return last, _active
@@ -1,9 +1,25 @@
+import os
+import threading
+import uuid
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from collections import OrderedDict, namedtuple
-from functools import lru_cache
-
-from portfolio.base import DBManager, date_to_key, TimeRange
+from collections import OrderedDict, defaultdict, namedtuple
+from operator import itemgetter
+
+import numpy as np
+
+from portfolio.archive import QuoteArchive
+from portfolio.base import (
+    DBManager, bump_generation, date_to_key, key_to_date, TimeRange)
+from portfolio.cache import QuoteCache, generation_cache
+from portfolio.config import (
+    JOB_TIMEOUT, QUOTE_PREFETCH_WORKERS, QUOTES_ARCHIVE, QUOTES_BUCKETS,
+    QUOTES_COVERAGE_GAP, QUOTES_FINAL_DELAY, SECURITIES_LOOKUP_DELAY,
+    SECURITIES_TTL, SNAPSHOT_DELAY)
 from portfolio.loaders import QuotesLoader
+from portfolio.prices import live_prices
 
 
 Quote = namedtuple('Quote', ['time', 'price', 'isin', 'figi', 'interval'])
@@ -13,8 +29,50 @@ class QuotesManager(DBManager):
     collection = 'quotes'
     model = Quote
 
+    indexes = (('isin', 'interval', 'time'), )
+    queries = (
+        {'isin': 'ISIN', 'interval': 'day', 'sort': 'time',
+         'time': TimeRange(datetime(2020, 1, 1), datetime(2020, 12, 31))},
+        {'isin': 'ISIN', 'interval': 'day', 'sort': ('time', -1)},
+    )
+
+    cache = QuoteCache()
+    # None for one document per quote, QuoteBucketsManager.MONTH or YEAR to
+    # read and write the bucketed layout
+    buckets = QUOTES_BUCKETS
+    # local archive of the final quotes, see export
+    archive_path = QUOTES_ARCHIVE
+    archive = None
+
+    @classmethod
+    def get_archive(cls):
+        if cls.archive is None and cls.archive_path and \
+                os.path.exists(cls.archive_path):
+            cls.archive = QuoteArchive(cls.archive_path)
+        return cls.archive
+
+    @classmethod
+    def export(cls, path, isins=None, interval=QuotesLoader.DAY):
+        # the quotes that can't change anymore are written to a memory-mapped
+        # archive, QuotesManager reads from it when archive_path is set
+        end_time = datetime.now() - timedelta(days=QUOTES_FINAL_DELAY)
+        if isins is None:
+            isins = cls.get_isins(interval)
+        quotes = {isin: cls.read(isin, interval, TimeRange(None, end_time))
+                  for isin in isins}
+        archive = QuoteArchive.write(path, quotes)
+        if path == cls.archive_path:
+            cls.archive = archive
+        return archive
+
+    @classmethod
+    def get_isins(cls, interval=QuotesLoader.DAY):
+        if cls.buckets:
+            return QuoteBucketsManager.distinct('isin', interval=interval,
+                                                size=cls.buckets)
+        return cls.distinct('isin', interval=interval)
+
     @classmethod
-    @lru_cache(maxsize=None)
     def get_quotes(cls, isin, time_range):
         today = date_to_key(datetime.now())
         new_range = time_range
@@ -22,99 +80,691 @@ class QuotesManager(DBManager):
             pre = time_range.end_time - timedelta(days=1)
             new_range = TimeRange(time_range.start_time, pre)
 
-        data = cls.get(isin=isin, time=new_range, sort='time',
-                       fields={'time': 1, 'price': 1})
-        result = OrderedDict()
+        price = None
+        if time_range.end == today:
+            price = live_prices.get(isin)
+
+        archive = cls.get_archive()
+        if archive is not None and archive.covers(isin, new_range):
+            extra = {today: price} if time_range.end == today else None
+            return archive.get_quotes(isin, new_range, extra)
 
-        last_date = None
+        if new_range.start is None:
+            result = cls._load_quotes(isin, new_range)
+        else:
+            cls.cache.sync(cls.get_generation())
+            result = cls.cache.get(isin, new_range.start, new_range.end)
+            if result is None:
+                result = cls._load_quotes(isin, new_range)
+                cls.cache.put(isin, new_range.start, new_range.end, result)
+            if time_range.end != today:
+                return result
+            view = cls.cache.get(isin, new_range.start, new_range.end, today,
+                                 price)
+            if view is not None:
+                return view
+            result = OrderedDict(result)
+
+        if time_range.end == today:
+            result[today] = price
+        return result
+
+    @classmethod
+    def prefetch(cls, isins, time_range, workers=QUOTE_PREFETCH_WORKERS):
+        # loads the missing history and live prices of all the instruments
+        # at once instead of one by one in the valuation loop
+        isins = list(dict.fromkeys(isins))
+        if len(isins) < 2 or workers < 2:
+            return {isin: cls.get_quotes(isin, time_range) for isin in isins}
+        with ThreadPoolExecutor(min(workers, len(isins))) as executor:
+            futures = [executor.submit(cls.get_quotes, isin, time_range)
+                       for isin in isins]
+            return {isin: future.result()
+                    for isin, future in zip(isins, futures)}
+
+    @classmethod
+    def append_today(cls, isin, interval=QuotesLoader.DAY):
+        # the candle of the current day, it is not covered so the regular
+        # loading requests it again once the day is over
+        now = datetime.now()
+        data = QuotesLoader.history(isin, TimeRange(now, now), interval)
+        cls.write(isin, interval, TimeRange(now, now), data)
+        return data
+
+    @classmethod
+    def _load_quotes(cls, isin, time_range, interval=QuotesLoader.DAY):
+        missing = []
+        if time_range.start_time:
+            missing = QuotesCoverageManager.get_missing(isin, time_range,
+                                                        interval)
+        for missing_range in missing:
+            last_time = None
+            for chunk in QuotesLoader.get_chunks(missing_range, interval):
+                data = QuotesLoader.history(isin, chunk, interval)
+                cls.write(isin, interval, chunk, data)
+                if data:
+                    last_time = data[-1]['time']
+            QuotesCoverageManager.add(isin, missing_range, interval,
+                                      last_time)
+        return cls.read(isin, interval, time_range)
+
+    @classmethod
+    def read(cls, isin, interval, time_range):
+        if cls.buckets:
+            return QuoteBucketsManager.read(isin, interval, time_range,
+                                           cls.buckets)
+
+        data = cls.get(isin=isin.upper(), interval=interval, time=time_range,
+                       sort='time', fields={'time': 1, 'price': 1})
+        result = OrderedDict()
         for record in data:
             result[date_to_key(record['time'])] = record['price']
-            last_date = record['time']
-            last_date += timedelta(days=1)
+        return result
 
-        if not last_date:
-            data = OrdersManager.get(isin=isin, sort=('time', -1))
-            if data:
-                last_date = data[0]['date']
-        if not last_date:
-            last_date = time_range.start_time
-
-        last_date = last_date.replace(hour=0, minute=0, second=0)
-        if date_to_key(last_date) < new_range.end:
-            new_range = TimeRange(last_date, new_range.end_time)
-            data = QuotesLoader.history(isin, new_range)
+    @classmethod
+    def write(cls, isin, interval, time_range, data):
+        if cls.buckets:
+            QuoteBucketsManager.write(isin, interval, time_range, data,
+                                      cls.buckets)
             if data:
-                cls.insert(data)
-                for record in data:
-                    if date_to_key(record['time']) > new_range.end:
-                        break
-                    result[date_to_key(record['time'])] = record['price']
+                cls.changed(data)
+            cls.bump_quotes(time_range)
+            return
+
+        # the quotes are upserted before the stale ones of the range are
+        # removed so the readers never see the range empty
+        key = {'isin': isin.upper(), 'interval': interval}
+        cls.bulk_upsert([dict(key, time=record['time']) for record in data],
+                        data)
+        times = {record['time'] for record in data}
+        stale = [record['time'] for record in
+                 cls.get(time=time_range, fields={'time': 1}, **key)
+                 if record['time'] not in times]
+        if stale:
+            cls.delete(time={'$in': stale}, **key)
+        cls.bump_quotes(time_range)
 
-        if time_range.end == today:
-            price = QuotesLoader.current(isin)
-            result[today] = price
+    @classmethod
+    def bump_quotes(cls, time_range=None):
+        # one new generation per written range instead of one per call to
+        # the database, the cached quotes are dropped on it. The candles of
+        # the current day are cached for QUOTE_CACHE_TTL only, the frequent
+        # writes of them keep the generation
+        if time_range is None or \
+                time_range.start < date_to_key(datetime.now()):
+            bump_generation(cls.collection)
+
+    @classmethod
+    def changed(cls, data):
+        # candles filling a hole change the stored valuations from that day,
+        # the currency rates value every portfolio, the other quotes only
+        # the portfolios with orders of the instrument
+        from portfolio.portfolio import Portfolio
+        limit = datetime.now() - timedelta(days=SNAPSHOT_DELAY)
+        first_times = {}
+        for record in data:
+            isin = record['isin'].upper()
+            if isin not in first_times or record['time'] < first_times[isin]:
+                first_times[isin] = record['time']
+
+        records = []
+        for isin, first_time in first_times.items():
+            if first_time >= limit:
+                continue
+            if isin in Portfolio.CURRENCIES:
+                SnapshotManager.invalidate(first_time)
+                continue
+            isins = [isin] + [old for old, new in Portfolio.CHANGES.items()
+                              if new.upper() == isin]
+            records.extend(dict(holder, date=first_time)
+                           for holder in OrdersManager.get_holders(isins))
+        if records:
+            SnapshotManager.invalidate_records(records)
+
+
+Coverage = namedtuple('Coverage', ['isin', 'interval', 'start', 'end'])
+
+
+class QuotesCoverageManager(DBManager):
+    collection = 'quotes_coverage'
+    model = Coverage
 
+    indexes = (('isin', 'interval', 'start'), )
+    queries = ({'isin': 'ISIN', 'interval': 'day', 'sort': 'start'}, )
+
+    @classmethod
+    def get_ranges(cls, isin, interval):
+        data = cls.get(isin=isin.upper(), interval=interval, sort='start')
+        ranges = [(date_to_key(row['start']), date_to_key(row['end']))
+                  for row in data]
+        if ranges:
+            return ranges
+
+        # quotes loaded before the coverage was tracked, the runs of the
+        # stored days are covered, the longer gaps are loaded again
+        runs = []
+        for key in QuotesManager.read(isin, interval, TimeRange(None, None)):
+            day = key_to_date(key)
+            if runs and day - runs[-1][1] <= QUOTES_COVERAGE_GAP:
+                runs[-1][1] = day
+            else:
+                runs.append([day, day])
+        if runs:
+            cls.insert([{
+                'isin': isin.upper(),
+                'interval': interval,
+                'start': TimeRange(start, end).start_time,
+                'end': TimeRange(start, end).end_time,
+            } for start, end in runs])
+        return [(date_to_key(start), date_to_key(end)) for start, end in runs]
+
+    @classmethod
+    def get_missing(cls, isin, time_range, interval):
+        missing = []
+        start = time_range.start_time
+        for range_start, range_end in cls.get_ranges(isin, interval):
+            if start > time_range.end_time:
+                break
+            range_start = key_to_date(range_start)
+            range_end = key_to_date(range_end)
+            if range_start > start:
+                missing.append(TimeRange(
+                    start, min(range_start - timedelta(days=1),
+                               time_range.end_time)))
+            start = max(start, range_end + timedelta(days=1))
+        if start <= time_range.end_time:
+            missing.append(TimeRange(start, time_range.end_time))
+        return missing
+
+    @classmethod
+    def add(cls, isin, time_range, interval, last_time=None):
+        # the latest days may get their candles later, they are covered only
+        # up to the last candle received
+        end_time = min(time_range.end_time,
+                       datetime.now() - timedelta(days=QUOTES_FINAL_DELAY))
+        if last_time:
+            end_time = max(end_time, min(last_time, time_range.end_time))
+        if end_time < time_range.start_time:
+            return
+
+        ranges = [(key_to_date(start), key_to_date(end)) for start, end in
+                  cls.get_ranges(isin, interval)]
+        ranges.append((time_range.start_time, end_time))
+        ranges.sort()
+        merged = [ranges[0]]
+        for start, end in ranges[1:]:
+            last_start, last_end = merged[-1]
+            if start <= last_end + timedelta(days=1):
+                merged[-1] = last_start, max(last_end, end)
+            else:
+                merged.append((start, end))
+
+        cls.delete(isin=isin.upper(), interval=interval)
+        cls.insert([{
+            'isin': isin.upper(),
+            'interval': interval,
+            'start': TimeRange(start, end).start_time,
+            'end': TimeRange(start, end).end_time,
+        } for start, end in merged])
+
+
+QuoteBucket = namedtuple('QuoteBucket', ['isin', 'figi', 'interval', 'size',
+                                         'bucket', 'time', 'price', 'last'])
+
+
+class QuoteBucketsManager(DBManager):
+    # quotes packed into one document per instrument and month or year with
+    # the parallel time and price arrays
+    collection = 'quote_buckets'
+    model = QuoteBucket
+
+    indexes = (('isin', 'interval', 'size', 'bucket'), )
+    queries = (
+        {'isin': 'ISIN', 'interval': 'day', 'size': 'month', 'sort': 'bucket',
+         'bucket': TimeRange(datetime(2020, 1, 1), datetime(2020, 12, 31))},
+    )
+
+    MONTH = 'month'
+    YEAR = 'year'
+    SIZES = (MONTH, YEAR, )
+
+    @classmethod
+    def get_bucket(cls, time, size):
+        if size == cls.YEAR:
+            return datetime(time.year, 1, 1)
+        return datetime(time.year, time.month, 1)
+
+    @classmethod
+    def get_buckets(cls, time_range, size):
+        bucket = cls.get_bucket(time_range.start_time, size)
+        while bucket <= time_range.end_time:
+            yield bucket
+            if size == cls.YEAR:
+                bucket = bucket.replace(year=bucket.year + 1)
+            elif bucket.month == 12:
+                bucket = bucket.replace(year=bucket.year + 1, month=1)
+            else:
+                bucket = bucket.replace(month=bucket.month + 1)
+
+    @classmethod
+    def read(cls, isin, interval, time_range, size):
+        filters = {'isin': isin.upper(), 'interval': interval, 'size': size,
+                   'sort': 'bucket', 'fields': {'time': 1, 'price': 1}}
+        if time_range.start_time:
+            filters['bucket'] = {
+                '$gte': cls.get_bucket(time_range.start_time, size)}
+        if time_range.end_time:
+            filters.setdefault('bucket', {})['$lte'] = time_range.end_time
+
+        result = OrderedDict()
+        for record in cls.get(**filters):
+            times = record['time']
+            left = 0
+            right = len(times)
+            if time_range.start_time:
+                left = bisect_left(times, time_range.start_time)
+            if time_range.end_time:
+                right = bisect_right(times, time_range.end_time)
+            for time, price in zip(times[left:right],
+                                   record['price'][left:right]):
+                result[date_to_key(time)] = price
         return result
 
+    @classmethod
+    def write(cls, isin, interval, time_range, data, size):
+        # replaces the quotes of the range, the new quotes after the last one
+        # of a bucket are appended in place
+        by_bucket = defaultdict(list)
+        for record in data:
+            by_bucket[cls.get_bucket(record['time'], size)].append(record)
+
+        for bucket in cls.get_buckets(time_range, size):
+            key = {'isin': isin.upper(), 'interval': interval, 'size': size,
+                   'bucket': bucket}
+            records = sorted(by_bucket[bucket], key=lambda item: item['time'])
+            if records:
+                appended = cls.append(
+                    dict(key, last={'$lt': time_range.start_time}),
+                    {'time': [record['time'] for record in records],
+                     'price': [record['price'] for record in records]},
+                    {'last': records[-1]['time']})
+                if appended:
+                    continue
+
+            record = cls.get_first(**key) or {}
+            quotes = {time: price for time, price in
+                      zip(record.get('time', ()), record.get('price', ()))
+                      if not (time_range.start_time <= time <=
+                              time_range.end_time)}
+            quotes.update((item['time'], item['price']) for item in records)
+            removed = len(quotes) < len(record.get('time', ()))
+            if not records and not removed:
+                continue
+            if not quotes:
+                cls.delete(**key)
+                continue
+            times = sorted(quotes)
+            figi = records[0]['figi'] if records else record['figi']
+            cls.upsert(key, dict(key, figi=figi, time=times,
+                                 price=[quotes[time] for time in times],
+                                 last=times[-1]))
 
-Money = namedtuple('Money', ['date', 'cur', 'sum', 'portfolio', 'broker',
-                             'comment'])
+    @classmethod
+    def migrate(cls, size=MONTH, batch=1000):
+        # rebuilds the buckets from the one document per quote layout
+        data = QuotesManager.get(
+            sort=['isin', 'interval', 'time'],
+            fields={'isin': 1, 'figi': 1, 'interval': 1, 'time': 1,
+                    'price': 1})
+        count = 0
+        keys = []
+        items = []
+        for record in data:
+            key = {'isin': record['isin'], 'interval': record['interval'],
+                   'size': size,
+                   'bucket': cls.get_bucket(record['time'], size)}
+            if not keys or keys[-1] != key:
+                if len(keys) >= batch:
+                    cls.bulk_upsert(keys, items)
+                    count += len(keys)
+                    keys = []
+                    items = []
+                keys.append(key)
+                items.append(dict(key, figi=record['figi'], time=[],
+                                  price=[]))
+            item = items[-1]
+            item['time'].append(record['time'])
+            item['price'].append(record['price'])
+            item['last'] = record['time']
+        cls.bulk_upsert(keys, items)
+        QuotesManager.bump_quotes()
+        return count + len(keys)
+
+
+Candles = namedtuple('Candles', ['isin', 'figi', 'interval', 'day', 'time',
+                                 'price'])
+
+
+class CandlesManager(DBManager):
+    # intraday candles, one document per instrument and day holding the
+    # seconds since the day start and the prices as packed arrays
+    collection = 'candles'
+    model = Candles
+
+    indexes = (('isin', 'interval', 'day'), )
+    queries = (
+        {'isin': 'ISIN', 'interval': 'hour', 'sort': 'day',
+         'day': TimeRange(datetime(2020, 1, 1), datetime(2020, 1, 31))},
+    )
+
+    INTERVALS = (QuotesLoader.MIN1, QuotesLoader.MIN5, QuotesLoader.MIN15,
+                 QuotesLoader.HOUR, )
+    TIME_TYPE = np.dtype('<i4')
+    PRICE_TYPE = np.dtype('<f8')
 
+    @classmethod
+    def get_candles(cls, isin, time_range, interval=QuotesLoader.HOUR):
+        if interval not in cls.INTERVALS:
+            raise ValueError(interval)
+        start = time_range.start
+        if start is None:
+            # the open range starts with the stored candles, the earlier
+            # ones are not requested
+            ranges = QuotesCoverageManager.get_ranges(isin, interval)
+            if not ranges:
+                raise ValueError(f'no {interval} candles of {isin} stored, '
+                                 f'the range start is required')
+            start = ranges[0][0]
+        end = time_range.end or date_to_key(datetime.now())
+        days = TimeRange(key_to_date(start), key_to_date(end))
+        cls._load_candles(isin, days, interval)
+
+        data = cls.get(isin=isin.upper(), interval=interval, day=days,
+                       sort='day', fields={'day': 1, 'time': 1, 'price': 1})
+        times = []
+        prices = []
+        for record in data:
+            day = np.datetime64(record['day'], 's')
+            times.append(day + np.frombuffer(record['time'], cls.TIME_TYPE))
+            prices.append(np.frombuffer(record['price'], cls.PRICE_TYPE))
+        if not times:
+            return np.array([], 'datetime64[s]'), np.array([], cls.PRICE_TYPE)
+        return np.concatenate(times), np.concatenate(prices)
 
-class MoneyManager(DBManager):
-    collection = 'money'
-    model = Money
+    @classmethod
+    def prefetch(cls, isins, time_range, interval=QuotesLoader.HOUR,
+                 workers=QUOTE_PREFETCH_WORKERS):
+        isins = list(dict.fromkeys(isins))
+        with ThreadPoolExecutor(max(min(workers, len(isins)), 1)) as executor:
+            futures = [executor.submit(cls.get_candles, isin, time_range,
+                                       interval) for isin in isins]
+            return {isin: future.result()
+                    for isin, future in zip(isins, futures)}
+
+    @classmethod
+    def _load_candles(cls, isin, time_range, interval):
+        missing = QuotesCoverageManager.get_missing(isin, time_range, interval)
+        for missing_range in missing:
+            for chunk in QuotesLoader.get_chunks(missing_range, interval):
+                cls.save(isin, interval,
+                         QuotesLoader.history(isin, chunk, interval))
+            # the days are covered once they are final, a day with candles
+            # may still get new ones
+            QuotesCoverageManager.add(isin, missing_range, interval)
+
+    @classmethod
+    def save(cls, isin, interval, data):
+        by_day = defaultdict(list)
+        for record in data:
+            by_day[record['time'].date()].append(record)
+
+        keys = []
+        items = []
+        for day, records in sorted(by_day.items()):
+            day = datetime(day.year, day.month, day.day)
+            records.sort(key=lambda record: record['time'])
+            times = np.array([(record['time'] - day).total_seconds()
+                              for record in records], cls.TIME_TYPE)
+            prices = np.array([record['price'] for record in records],
+                              cls.PRICE_TYPE)
+            key = {'isin': isin.upper(), 'interval': interval, 'day': day}
+            keys.append(key)
+            items.append(dict(key, figi=records[0]['figi'],
+                              time=times.tobytes(), price=prices.tobytes()))
+        return cls.bulk_upsert(keys, items)
+
+
+Snapshot = namedtuple('Snapshot', ['date', 'kind', 'cur', 'value', 'state',
+                                   'portfolio', 'broker'])
+
+
+class SnapshotManager(DBManager):
+    collection = 'snapshots'
+    model = Snapshot
+
+    indexes = (('portfolio', 'kind', 'cur', 'broker', 'date'), ('date', ), )
+    queries = (
+        {'kind': 'value', 'cur': 'RUB', 'portfolio': 1, 'broker': None,
+         'date': TimeRange(None, datetime(2020, 12, 31)),
+         'sort': ('date', -1)},
+        {'portfolio': 1, 'broker': {'$in': [1, None]},
+         'date': TimeRange(datetime(2020, 1, 1), None)},
+        {'date': TimeRange(datetime(2020, 1, 1), None)},
+    )
+
+    VALUE = 'value'
+    CBR = 'cbr'
+
+    _local = threading.local()
+
+    @classmethod
+    def get_last(cls, kind, cur, portfolio_id, broker_id, end_time):
+        data = cls.get(kind=kind, cur=cur, portfolio=portfolio_id,
+                       broker=broker_id, date=TimeRange(None, end_time),
+                       sort=('date', -1)).limit(1)
+        for row in data:
+            return cls.model(date=date_to_key(row['date']), kind=row['kind'],
+                             cur=row['cur'], value=row['value'],
+                             state=row['state'], portfolio=row['portfolio'],
+                             broker=row['broker'])
+
+    @classmethod
+    def get_values(cls, kind, cur, portfolio_id, broker_id, time_range):
+        data = cls.get(kind=kind, cur=cur, portfolio=portfolio_id,
+                       broker=broker_id, date=time_range, sort='date',
+                       fields={'_id': 0, 'date': 1, 'value': 1})
+        return [(date_to_key(row['date']), row['value']) for row in data]
+
+    @classmethod
+    def save(cls, kind, cur, portfolio_id, broker_id, snapshots):
+        if not snapshots:
+            return
+        time_range = TimeRange(key_to_date(snapshots[0][0]),
+                               key_to_date(snapshots[-1][0]))
+        cls.delete(kind=kind, cur=cur, portfolio=portfolio_id,
+                   broker=broker_id, date=time_range)
+        cls.insert([{
+            'date': key_to_date(date),
+            'kind': kind,
+            'cur': cur,
+            'value': value,
+            'state': state,
+            'portfolio': portfolio_id,
+            'broker': broker_id,
+        } for date, value, state in snapshots])
+
+    @classmethod
+    @contextmanager
+    def deferred(cls):
+        # collects invalidations of a batch write and applies them at once
+        if getattr(cls._local, 'pending', None) is not None:
+            yield
+            return
+        cls._local.pending = {}
+        try:
+            yield
+        finally:
+            pending, cls._local.pending = cls._local.pending, None
+            for (portfolio_id, broker_id), date in pending.items():
+                cls.invalidate(date, portfolio_id, broker_id)
+
+    @classmethod
+    def invalidate_records(cls, records):
+        dates = {}
+        for record in records:
+            key = record.get('portfolio'), record.get('broker')
+            date = record['date']
+            if key not in dates or date < dates[key]:
+                dates[key] = date
+
+        pending = getattr(cls._local, 'pending', None)
+        for key, date in dates.items():
+            if pending is None:
+                cls.invalidate(date, *key)
+            elif key not in pending or date < pending[key]:
+                pending[key] = date
 
     @classmethod
+    def invalidate(cls, date, portfolio_id=None, broker_id=None):
+        filters = {'date': TimeRange(date, None)}
+        if portfolio_id:
+            filters['portfolio'] = portfolio_id
+        if broker_id:
+            filters['broker'] = {'$in': [broker_id, None]}
+        cls.delete(**filters)
+
+
+DailySum = namedtuple('DailySum', ['date', 'cur', 'sum'])
+
+
+class LedgerManager(DBManager):
+    indexes = (('portfolio', 'date'), ('portfolio', 'broker', 'date'), )
+    queries = (
+        {'portfolio': 1, 'sort': ('date', 1),
+         'date': TimeRange(datetime(2020, 1, 1), datetime(2020, 12, 31))},
+        {'portfolio': 1, 'broker': 1, 'sort': ('date', 1),
+         'date': TimeRange(None, datetime(2020, 12, 31))},
+        # the duplicate checks of the parsers
+        {'portfolio': 1, 'broker': 1, 'date': datetime(2020, 1, 1),
+         'cur': 'RUB', 'sum': 1.0},
+    )
+    generations = True
+
+    # fields returned as float arrays by get_data(columns=True)
+    numeric = ('sum', )
+
+    @classmethod
+    @generation_cache()
     def get_data(cls, portfolio_id=None, time_range=None, broker_id=None,
-                 sort=1):
-        filters = {'sort': ('date', sort)}
+                 sort=1, columns=False):
+        fields = cls.model._fields
+        projection = dict.fromkeys(fields, 1)
+        projection['_id'] = 0
+        filters = cls._get_ledger_filters(portfolio_id, time_range, broker_id)
+        filters.update({'sort': ('date', sort), 'fields': projection})
+        # the values in the order of the model fields, date is the first one
+        rows = list(map(itemgetter(*fields), cls.get(**filters)))
+        if columns:
+            return cls.get_columns(rows)
+
+        keys = {date: date_to_key(date) for date in {row[0] for row in rows}}
+        make = cls.model._make
+        return [make((keys[row[0]], ) + row[1:]) for row in rows]
+
+    @staticmethod
+    def _get_ledger_filters(portfolio_id, time_range, broker_id):
+        filters = {}
         if broker_id:
             filters['broker'] = broker_id
         if portfolio_id:
             filters['portfolio'] = portfolio_id
         if time_range:
             filters['date'] = time_range
-        data = cls.get(**filters)
-        data = [cls.model(date=date_to_key(row['date']), cur=row['cur'],
-                          sum=row['sum'], portfolio=row['portfolio'],
-                          broker=row['broker'], comment=row['comment'])
-                for row in data]
-        return data
+        return filters
+
+    @classmethod
+    @generation_cache()
+    def get_daily_sums(cls, portfolio_id=None, time_range=None,
+                       broker_id=None):
+        # the sums of each day and currency sorted by date and currency,
+        # grouped by the database when it is mongo
+        filters = cls._get_ledger_filters(portfolio_id, time_range, broker_id)
+        if cls.can_aggregate():
+            data = cls.aggregate([
+                {'$match': cls._get_filters(filters)},
+                {'$group': {
+                    '_id': {'year': {'$year': '$date'},
+                            'month': {'$month': '$date'},
+                            'day': {'$dayOfMonth': '$date'},
+                            'cur': '$cur'},
+                    'sum': {'$sum': '$sum'}}},
+                {'$sort': {'_id.year': 1, '_id.month': 1, '_id.day': 1,
+                           '_id.cur': 1}},
+            ])
+            return [DailySum((row['_id']['year'], row['_id']['month'],
+                              row['_id']['day']), row['_id']['cur'],
+                             row['sum'])
+                    for row in data]
+
+        sums = defaultdict(float)
+        data = cls.get(fields={'_id': 0, 'date': 1, 'cur': 1, 'sum': 1},
+                       **filters)
+        for row in data:
+            sums[date_to_key(row['date']), row['cur']] += row['sum']
+        return [DailySum(date, cur, value)
+                for (date, cur), value in sorted(sums.items())]
 
+    @classmethod
+    def get_columns(cls, rows):
+        fields = cls.model._fields
+        values = list(zip(*rows)) or [()] * len(fields)
+        result = {}
+        for field, column in zip(fields, values):
+            if field == 'date':
+                result[field] = np.array(column, 'datetime64[D]')
+            elif field in cls.numeric:
+                result[field] = np.array(column, np.float64)
+            else:
+                result[field] = np.array(column, object)
+        return result
 
-class MoneyManagerCached(MoneyManager):
     @classmethod
-    @lru_cache(maxsize=None)
-    def get_data(cls, *args, **kwargs):
-        return super().get_data(*args, **kwargs)
+    def changed(cls, data):
+        SnapshotManager.invalidate_records(data)
+
+
+Money = namedtuple('Money', ['date', 'cur', 'sum', 'portfolio', 'broker',
+                             'comment'])
+
+
+class MoneyManager(LedgerManager):
+    collection = 'money'
+    model = Money
 
 
 Order = namedtuple('Order', ['date', 'isin', 'quantity', 'price', 'sum', 'cur',
                              'portfolio', 'broker', 'market'])
 
 
-class OrdersManager(DBManager):
+class OrdersManager(LedgerManager):
     collection = 'orders'
     model = Order
+    numeric = ('quantity', 'price', 'sum', )
 
     @classmethod
-    def get_data(cls, portfolio_id=None, time_range=None, broker_id=None,
-                 sort=1):
-        filters = {'sort': ('date', sort)}
-        if broker_id:
-            filters['broker'] = broker_id
-        if portfolio_id:
-            filters['portfolio'] = portfolio_id
-        if time_range:
-            filters['date'] = time_range
-        data = cls.get(**filters)
-        data = [cls.model(date=date_to_key(row['date']), isin=row['isin'],
-                          quantity=row['quantity'], sum=row['sum'],
-                          cur=row['cur'], portfolio=row['portfolio'],
-                          broker=row['broker'], price=row['price'],
-                          market=row['market']) for row in data]
-        return data
+    def get_holders(cls, isins):
+        # the portfolio and broker pairs with orders of the instruments
+        holders = {(row['portfolio'], row['broker']) for row in cls.get(
+            isin={'$in': isins}, fields={'portfolio': 1, 'broker': 1})}
+        return [{'portfolio': portfolio, 'broker': broker}
+                for portfolio, broker in holders]
+
+    @classmethod
+    def get_held_isins(cls):
+        quantities = defaultdict(int)
+        for row in cls.get(fields={'isin': 1, 'quantity': 1}):
+            quantities[row['isin']] += row['quantity']
+        return [isin for isin, quantity in quantities.items() if quantity]
 
 
 class SecuritiesManager(DBManager):
@@ -123,64 +773,216 @@ class SecuritiesManager(DBManager):
         'USD': 'USD000UTSTOM',
         'EUR': 'EUR_RUB__TOM',
     }
+    INDEXES = ('isin', 'figi', 'ticker', )
+    # the lookups are served by the in-memory indexes, the database is
+    # queried by figi when the catalog is refreshed
+    indexes = (('figi', ), )
+    queries = ({'figi': 'FIGI'}, )
+    # the in-memory indexes are rebuilt on a new generation
+    generations = True
+
+    _lock = threading.Lock()
+    _indexes = None
+    _refreshed = None
+    _generation = None
+    # isin -> time of the last lookup of an instrument missing in the catalog
+    _lookups = {}
+    # reload a stale catalog on a miss, off in the import workers which get
+    # it refreshed by the parent process
+    auto_refresh = True
 
     @classmethod
-    @lru_cache(maxsize=None)
     def get_data(cls, isin):
         if isin in cls.by_ticker:
-            data = cls.get(ticker=cls.by_ticker[isin], first=True)
+            data = cls.find(ticker=cls.by_ticker[isin])
         else:
-            data = cls.get(isin=isin, first=True)
+            data = cls.find(isin=isin)
         assert data
         return data
 
+    @classmethod
+    def find(cls, **kwargs):
+        assert len(kwargs) == 1
+        field, value = kwargs.popitem()
+        value = value.upper()
+        data = cls._get_indexes()[field].get(value)
+        if data is None and cls.auto_refresh and cls.is_stale():
+            data = cls.refresh()[field].get(value)
+        elif data is None and field == 'isin':
+            data = cls.lookup(value)
+        return data
+
+    @classmethod
+    def is_stale(cls):
+        cls._get_indexes()
+        return (cls._refreshed is None or
+                datetime.now() - cls._refreshed > SECURITIES_TTL)
+
+    @classmethod
+    def lookup(cls, isin):
+        # an instrument missing from the fresh catalog is requested alone,
+        # at most once per SECURITIES_LOOKUP_DELAY
+        now = datetime.now()
+        with cls._lock:
+            last = cls._lookups.get(isin)
+            if last is not None and now - last < SECURITIES_LOOKUP_DELAY:
+                return None
+            cls._lookups[isin] = now
+
+        data = QuotesLoader.get_securities_data(isin)
+        if data is None:
+            return None
+        # not marked as updated, the age of the catalog is kept
+        cls.upsert({'figi': data['figi']}, data)
+        return cls._get_indexes()['isin'].get(isin)
+
+    @classmethod
+    def _get_indexes(cls):
+        indexes = cls._indexes
+        if indexes is None or cls._generation != cls.get_generation():
+            with cls._lock:
+                generation = cls.get_generation()
+                if cls._indexes is None or cls._generation != generation:
+                    data = list(cls.get(fields={'_id': 0}))
+                    cls._refreshed = max(
+                        (row['updated'] for row in data if 'updated' in row),
+                        default=None)
+                    cls._indexes = cls._build_indexes(data)
+                    cls._generation = generation
+                indexes = cls._indexes
+        return indexes
+
+    @classmethod
+    def _build_indexes(cls, data):
+        indexes = {field: {} for field in cls.INDEXES}
+        for row in data:
+            for field in cls.INDEXES:
+                if row.get(field):
+                    indexes[field][row[field].upper()] = row
+        return indexes
+
+    @classmethod
+    def refresh(cls):
+        # reloads the whole catalog of instruments from the API
+        with cls._lock:
+            now = datetime.now()
+            data = QuotesLoader.get_instruments()
+            for row in data:
+                row['updated'] = now
+            keys = [{'figi': row['figi']} for row in data]
+            cls.bulk_upsert(keys, data)
+            generation = cls.get_generation()
+            data = list(cls.get(fields={'_id': 0}))
+            cls._indexes = cls._build_indexes(data)
+            cls._generation = generation
+            cls._refreshed = now
+            return cls._indexes
+
 
 Dividend = namedtuple('Dividend', ['date', 'cur', 'sum', 'portfolio', 'broker',
                                    'comment'])
 
 
-class DividendManager(DBManager):
+class DividendManager(LedgerManager):
     collection = 'dividends'
     model = Dividend
 
-    @classmethod
-    def get_data(cls, portfolio_id=None, time_range=None, broker_id=None,
-                 sort=1):
-        filters = {'sort': ('date', sort)}
-        if broker_id:
-            filters['broker'] = broker_id
-        if portfolio_id:
-            filters['portfolio'] = portfolio_id
-        if time_range:
-            filters['date'] = time_range
-        data = cls.get(**filters)
-        data = [cls.model(date=date_to_key(row['date']), cur=row['cur'],
-                          sum=row['sum'], portfolio=row['portfolio'],
-                          broker=row['broker'], comment=row['comment'])
-                for row in data]
-        return data
-
 
 Commission = namedtuple('Commission', ['date', 'cur', 'sum', 'comment',
                                        'portfolio', 'broker'])
 
 
-class CommissionManager(DBManager):
+class CommissionManager(LedgerManager):
     collection = 'commission'
     model = Commission
 
+
+Report = namedtuple('Report', ['hash', 'name', 'broker', 'portfolio', 'date',
+                               'count'])
+
+
+class ReportsManager(DBManager):
+    # content hashes of the imported report files
+    collection = 'reports'
+    model = Report
+
+    indexes = (('hash', ), )
+    queries = ({'hash': {'$in': ['0' * 64]}}, )
+
     @classmethod
-    def get_data(cls, portfolio_id=None, time_range=None, broker_id=None):
-        filters = {'sort': 'date'}
-        if broker_id:
-            filters['broker'] = broker_id
-        if portfolio_id:
-            filters['portfolio'] = portfolio_id
-        if time_range:
-            filters['date'] = time_range
-        data = cls.get(**filters)
-        data = [cls.model(date=date_to_key(row['date']), cur=row['cur'],
-                          sum=row['sum'], portfolio=row['portfolio'],
-                          broker=row['broker'], comment=row['comment'])
-                for row in data]
-        return data
+    def get_hashes(cls, hashes):
+        data = cls.get(hash={'$in': list(hashes)},
+                       fields={'_id': 0, 'hash': 1})
+        return {row['hash'] for row in data}
+
+
+Job = namedtuple('Job', ['job', 'kind', 'status', 'progress', 'error',
+                         'result', 'created', 'updated'])
+
+
+class JobsManager(DBManager):
+    # state of the background jobs, written by the workers and polled by
+    # the web app
+    collection = 'jobs'
+    model = Job
+
+    indexes = (('job', ), )
+    queries = ({'job': '0' * 32}, )
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    @classmethod
+    def create(cls, kind):
+        job = uuid.uuid4().hex
+        now = datetime.now()
+        cls.insert({
+            'job': job,
+            'kind': kind,
+            'status': cls.QUEUED,
+            'progress': 0,
+            'error': None,
+            'result': None,
+            'created': now,
+            'updated': now,
+        })
+        return job
+
+    @classmethod
+    def update(cls, job, **data):
+        data['updated'] = datetime.now()
+        cls.upsert({'job': job}, data)
+
+    @classmethod
+    def find(cls, job):
+        row = cls.get(job=job, first=True)
+        if row is None:
+            return None
+        row.pop('_id', None)
+        job = cls.model(**row)
+        if job.status in (cls.QUEUED, cls.RUNNING) and \
+                datetime.now() - job.updated > JOB_TIMEOUT:
+            job = job._replace(status=cls.FAILED,
+                               error='Job lost, no update since '
+                                     f'{job.updated:%Y-%m-%d %H:%M:%S}')
+            cls.update(job.job, status=job.status, error=job.error)
+        return job
+
+
+MANAGERS = (QuotesManager, QuotesCoverageManager, QuoteBucketsManager,
+            CandlesManager, SnapshotManager, MoneyManager, OrdersManager,
+            SecuritiesManager, DividendManager, CommissionManager,
+            ReportsManager, JobsManager, )
+
+
+def ensure_indexes():
+    # create_index is a no-op for the existing indexes
+    for manager in MANAGERS:
+        manager.ensure_indexes()
+
+
+def audit_indexes():
+    return [(manager.collection, query, stages)
+            for manager in MANAGERS for query, stages in manager.audit()]
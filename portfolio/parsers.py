@@ -1,45 +1,209 @@
-from datetime import datetime
-from itertools import chain
+import io
+import os
+import time
+from collections import defaultdict
+from functools import lru_cache
+from operator import itemgetter
 
 import xml.etree.ElementTree as etree
 
+from portfolio.config import PARSER_BATCH_SIZE, PARSER_PROGRESS_INTERVAL
 from portfolio.managers import (
-    Order, Dividend, DividendManager, Commission, CommissionManager,
-    Money, MoneyManager, OrdersManager, SecuritiesManager, QuotesLoader)
+    DividendManager, CommissionManager, MoneyManager, OrdersManager,
+    SecuritiesManager, SnapshotManager)
 from portfolio.portfolio import Portfolio
+from portfolio.schema import (
+    Field, choice, compile_schema, currency, date, get_namespace, integer,
+    timestamp)
 
 
 class Parser:
     BROKER = None
     MARKETS = None
+    # the tails of the collection paths -> the method parsing the values of
+    # their records into (manager, data) or None for the skipped ones
+    COLLECTIONS = {}
+    # the method -> the fields of its records
+    SCHEMA = {}
+    # the methods reading only the first of the collections they match
+    FIRST = ()
 
     def __init__(self, portfolio):
         self.portfolio = {'portfolio': portfolio, 'broker': self.BROKER}
+        self.records = []
+        # manager -> the keys of the records of a test run, nothing is
+        # written so the repeated ones are found by them
+        self.seen = defaultdict(set)
+
+    def parse(self, content, test=True, progress=None, collect=None):
+        # the records are written by batches while the report is streamed,
+        # the new items of each batch are passed to collect or returned at
+        # the end, progress is called at most every PARSER_PROGRESS_INTERVAL
+        items = []
+        collect = collect or items.extend
+        reported = time.monotonic()
+        for manager, data in self.iter_items(content):
+            self.add(manager, data)
+            if len(self.records) >= PARSER_BATCH_SIZE:
+                collect(self.commit(test))
+            if progress is not None and \
+                    time.monotonic() - reported >= PARSER_PROGRESS_INTERVAL:
+                progress()
+                reported = time.monotonic()
+        collect(self.commit(test))
+        return items
+
+    def iter_items(self, content):
+        for section, record in self.iter_records(content):
+            extract = self.get_extractor(section, get_namespace(record.tag))
+            item = getattr(self, section)(extract(record))
+            if item is not None:
+                yield item
+
+    def add(self, manager, data):
+        self.records.append((manager, data))
+
+    def commit(self, test=True):
+        # one unordered bulk upsert per collection, the stored and the
+        # repeated records are matched instead of inserted, nothing is kept
+        # between the batches, returns the new items in the order they were
+        # parsed
+        by_manager = defaultdict(list)
+        for index, (manager, data) in enumerate(self.records):
+            by_manager[manager].append((index, data))
+        self.records = []
+
+        items = []
+        for manager, records in by_manager.items():
+            if test:
+                new = self.get_new(manager, records)
+            else:
+                response = manager.bulk_upsert(
+                    [data for _, data in records],
+                    [data for _, data in records])
+                new = [records[i] for i in sorted(response.upserted_ids)]
+            items.extend((index, manager.model(**data)) for index, data in new)
+        return [item for _, item in sorted(items, key=itemgetter(0))]
+
+    def get_new(self, manager, records):
+        # the records of the batch missing in the database and in the
+        # previous batches, without writing
+        fields = sorted(records[0][1])
+        dates = [data['date'] for _, data in records]
+        stored = manager.get(
+            date={'$gte': min(dates), '$lte': max(dates)},
+            fields={field: 1 for field in fields}, **self.portfolio)
+        stored = {tuple(row.get(field) for field in fields) for row in stored}
+        seen = self.seen[manager]
+
+        new = []
+        for index, data in records:
+            key = tuple(data[field] for field in fields)
+            if key not in stored and key not in seen:
+                seen.add(key)
+                new.append((index, data))
+        return new
+
+    @staticmethod
+    def local_name(tag):
+        return tag.rpartition('}')[2]
+
+    @staticmethod
+    def get_source(content):
+        if isinstance(content, str):
+            content = content.encode()
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+        return content
 
     @classmethod
-    def get_child(cls, root, child_tag):
-        for child in root:
-            if child_tag in child.tag:
-                return child
-        raise ValueError('not found')
+    def get_section(cls, path):
+        # the method of the collection the path ends with
+        for tail, method in cls.COLLECTIONS.items():
+            if tuple(path[-len(tail):]) == tail:
+                return method
+        return None
 
     @classmethod
-    def get(cls, root, *names):
-        if len(names) == 1:
-            names = names[0]
-            names = names.split('.')
-        for name in names:
-            root = cls.get_child(root, name)
-            if root is None:
-                raise ValueError('not found')
-        return root
+    def iter_records(cls, content):
+        # yields (method, record) as the closing tag of each record of the
+        # COLLECTIONS arrives, the processed elements are cleared and
+        # detached so only the current record is kept in memory
+        found = False
+        path = []
+        elements = []
+        record = section = None
+        # method -> its first collection element
+        first = {}
+        for event, element in etree.iterparse(cls.get_source(content),
+                                              ('start', 'end')):
+            if event == 'start':
+                path.append(cls.local_name(element.tag))
+                elements.append(element)
+                if record is None:
+                    section = cls.get_section(path[:-1])
+                    if section in cls.FIRST:
+                        collection = first.setdefault(section, elements[-2])
+                        if collection is not elements[-2]:
+                            section = None
+                    if section is not None:
+                        record = element
+                    elif cls.get_section(path) is not None:
+                        found = True
+                continue
+
+            path.pop()
+            elements.pop()
+            if record is not None:
+                if element is not record:
+                    continue
+                yield section, record
+                record = section = None
+            element.clear()
+            if elements:
+                elements[-1].remove(element)
+
+        if not found:
+            raise ValueError('not found')
 
     @classmethod
-    def get_silent(cls, root, *names):
-        try:
-            return cls.get(root, *names)
-        except ValueError:
-            return []
+    @lru_cache(maxsize=None)
+    def get_extractor(cls, section, namespace):
+        return compile_schema(cls.SCHEMA[section], namespace)
+
+    @staticmethod
+    def get_price(isin, price):
+        security = SecuritiesManager.find(isin=isin)
+        if not security:
+            raise ValueError(isin)
+
+        security_type = security['type']
+        if security_type == 'Bond':
+            return security['faceValue'] * price / 100
+        elif security_type not in ('Stock', 'Etf',):
+            raise ValueError(security_type)
+        return price
+
+    def get_order(self, values):
+        return {
+            'date': values['date'],
+            'quantity': values['quantity'],
+            'price': values['price'],
+            'sum': values['sum'],
+            'cur': values['cur'],
+            'market': values['market'],
+            'isin': values['isin'],
+            **self.portfolio,
+        }
+
+    def get_transfer(self, values):
+        return {
+            'sum': values['sum'],
+            'comment': values['comment'],
+            'cur': values['cur'],
+            'date': values['date'],
+            **self.portfolio,
+        }
 
 
 class AlfaParser(Parser):
@@ -51,145 +215,74 @@ class AlfaParser(Parser):
         'МБ ВР': 'MB',
         'OTC НРД': 'MB',
     }
+    COLLECTIONS = {
+        ('Trades', 'Report', 'Tablix2', 'Details_Collection'): 'parse_order',
+        ('Trades', 'Report', 'Tablix3', 'Details2_Collection'): 'parse_order',
+        ('settlement_date', 'rn_Collection'): 'parse_transfer',
+    }
+    # the element of the first currency with a non-empty volume
+    AMOUNT = ('oper_type/comment/money_volume_begin1_Collection/'
+              'money_volume_begin1/p_code_Collection/p_code/p_code[volume]')
+    SCHEMA = {
+        'parse_order': {
+            'isin': Field(('isin_reg', 'isin_reg1'), default=''),
+            'name': Field(('p_name', 'p_name2'), default=''),
+            'place': Field(('place_name', 'place_name2')),
+            'comment': Field(('comment', 'comment2'), default=''),
+            'date': Field(('db_time', 'db_time2'),
+                          convert=date('%d.%m.%Y %H:%M:%S')),
+            'quantity': Field(('qty', 'qty2'), convert=integer),
+            'price': Field(('Price', 'Price2'), convert=float),
+            'sum': Field(('summ_trade', 'summ_trade2'), convert=float),
+            'cur': Field(('curr_calc', 'curr_calc2'), convert=currency),
+        },
+        'parse_transfer': {
+            'date': Field('last_update', convert=timestamp),
+            'oper_type': Field('oper_type', path='oper_type'),
+            'comment': Field('comment', path='oper_type/comment',
+                             convert=str.lower, default=''),
+            'sum': Field('volume', path=AMOUNT, convert=float),
+            'cur': Field('p_code', path=AMOUNT, convert=currency),
+        },
+    }
 
-    @classmethod
-    def parse_record(cls, record):
-        date = record.attrib['last_update']
-        curs = cls.get(record, 'oper_type', 'comment',
-                       'money_volume_begin1_Collection',
-                       'money_volume_begin1', 'p_code_Collection')
-        for cur in curs:
-            volume = cls.get(cur, 'p_code').attrib.get('volume')
-            if volume:
-                cur_code = cls.get(cur, 'p_code').attrib['p_code']
-                time = datetime.strptime(date, '%Y-%m-%dT%H:%M:%S')
-                return time, float(volume), cur_code
-        raise ValueError('unable to parse')
-
-    def parse(self, content, test=True):
-        root = etree.fromstring(content)
-        items = []
-
-        # orders section
-        collection1 = self.get(root, 'Trades', 'Report', 'Tablix2')
-        try:
-            collection1 = self.get_child(collection1, 'Details_Collection')
-        except ValueError:
-            collection1 = []
-
-        collection2 = self.get(root, 'Trades', 'Report', 'Tablix3')
-        try:
-            collection2 = self.get_child(collection2, 'Details2_Collection')
-        except ValueError:
-            collection2 = []
-
-        for record in chain(collection1, collection2):
-            isin = (record.attrib.get('isin_reg') or
-                    record.attrib.get('isin_reg1')).strip()
-            if not isin:
-                isin = (record.attrib.get('p_name') or
-                        record.attrib.get('p_name2')).strip()
-                assert isin in ('EUR', 'USD')
-
-            market = (record.attrib.get('place_name') or
-                      record.attrib.get('place_name2')).strip()
-            comment = (record.attrib.get('comment') or
-                       record.attrib.get('comment2') or '').strip()
-            if comment:
-                continue
-            if market == 'МБ ВР':
-                continue
-
-            db_time = (record.attrib.get('db_time') or
-                       record.attrib.get('db_time2')).strip()
-            qty = (record.attrib.get('qty') or
-                   record.attrib.get('qty2')).strip()
-            price = (record.attrib.get('Price') or
-                     record.attrib.get('Price2')).strip()
-            summ_trade = (record.attrib.get('summ_trade') or
-                          record.attrib.get('summ_trade2')).strip()
-            curr_calc = (record.attrib.get('curr_calc') or
-                         record.attrib.get('curr_calc2')).strip()
-
-            data = {
-                'date': datetime.strptime(' '.join(db_time.split()[:2]),
-                                          '%d.%m.%Y %H:%M:%S'),
-                'quantity': int(float(qty)),
-                'price': float(price),
-                'sum': float(summ_trade),
-                'cur': curr_calc,
-                'market': self.MARKETS[market],
-                'isin': isin,
-                **self.portfolio,
-            }
-
-            security = SecuritiesManager.get(isin=isin, first=True)
-            if not security:
-                security = QuotesLoader.get_securities_data(isin)
-                SecuritiesManager.upsert(security)
-
-            security_type = security['type']
-            if security_type == 'Bond':
-                data['price'] = security['faceValue'] * data['price'] / 100
-            elif security_type not in ('Stock', 'Etf',):
-                raise ValueError(security_type)
-
-            if OrdersManager.get_first(**data) is not None:
-                continue
-
-            if test:
-                items.append(Order(**data))
+    def parse_order(self, values):
+        if not values['isin']:
+            values['isin'] = values['name']
+            assert values['isin'] in ('EUR', 'USD')
+
+        if values['comment']:
+            return None
+        if values['place'] == 'МБ ВР':
+            return None
+
+        values['market'] = self.MARKETS[values['place']]
+        values['price'] = self.get_price(values['isin'], values['price'])
+        return OrdersManager, self.get_order(values)
+
+    def parse_transfer(self, values):
+        oper_type = values['oper_type']
+        comment = values['comment']
+
+        if oper_type == 'Перевод':
+            if any(word in comment for word in (
+                    'купон', 'dividend', 'дивиденд')):
+                manager = DividendManager
+            elif any(word in comment for word in (
+                    'списание по поручению клиента', 'между рынками',
+                    'из ао "альфа-банк"')):
+                manager = MoneyManager
             else:
-                #OrdersManager.insert(data)
-                if 'upserted' in OrdersManager.upsert(data):
-                    items.append(Order(**data))
-
-        # money transfer section
-        collection = self.get(root, 'Trades2', 'Report', 'Tablix1',
-                              'settlement_date_Collection')
-        for day in collection:
-            for record in self.get(day, 'rn_Collection'):
-                time, volume, cur_code = self.parse_record(record)
-                oper_type = self.get(record, 'oper_type').attrib[
-                    'oper_type'].strip()
-                comment = self.get(record, 'oper_type', 'comment').attrib[
-                    'comment'].lower()
-
-                if oper_type == 'Перевод':
-                    if any(word in comment for word in (
-                            'купон', 'dividend', 'дивиденд')):
-                        manager = DividendManager
-                        model = Dividend
-                    elif any(word in comment for word in (
-                            'списание по поручению клиента', 'между рынками',
-                            'из ао "альфа-банк"')):
-                        manager = MoneyManager
-                        model = Money
-                    else:
-                        raise ValueError(comment)
-                elif oper_type == 'Комиссия' or oper_type == 'НДФЛ':
-                    manager = CommissionManager
-                    model = Commission
-                    volume = abs(volume)
-                else:
-                    if oper_type not in ('НКД по сделке', 'Расчеты по сделке'):
-                        raise ValueError(oper_type)
-                    continue
+                raise ValueError(comment)
+        elif oper_type == 'Комиссия' or oper_type == 'НДФЛ':
+            manager = CommissionManager
+            values['sum'] = abs(values['sum'])
+        else:
+            if oper_type not in ('НКД по сделке', 'Расчеты по сделке'):
+                raise ValueError(oper_type)
+            return None
 
-                data = {
-                    'sum': volume,
-                    'comment': comment,
-                    'cur': cur_code,
-                    'date': time,
-                    **self.portfolio,
-                }
-                if test:
-                    if manager.get_first(**data) is None:
-                        items.append(model(**data))
-                else:
-                    if 'upserted' in manager.upsert(data):
-                        items.append(model(**data))
-        return items
+        return manager, self.get_transfer(values)
 
 
 class VtbParser(Parser):
@@ -202,151 +295,80 @@ class VtbParser(Parser):
         'Валютный рынок ПАО «Московская биржа»': 'MB',
         'ПАО «Санкт-Петербургская биржа»': 'SPB',
     }
+    COLLECTIONS = {
+        ('Tablix_b9', 'Подробности9_Collection'): 'parse_order',
+        ('Tablix_b10', 'Подробности6_Collection'): 'parse_currency_order',
+        ('Tablix_b4', 'DDS_place_Collection', 'DDS_place',
+         'Подробности16_Collection'): 'parse_transfer',
+    }
+    # the transfers of the first place only
+    FIRST = ('parse_transfer', )
+    SCHEMA = {
+        'parse_order': {
+            'market': Field('deal_place7', convert=choice(MARKETS)),
+            'date': Field('curs_datebeg9', convert=timestamp),
+            'isin': Field('NameBeg9',
+                          convert=lambda value: value.split(',')[-1].strip()),
+            'direction': Field('currency_ISO9'),
+            'quantity': Field('NameEnd9', convert=integer),
+            'price': Field('deal_price7', convert=float),
+            'sum': Field('currency_paym7', convert=float),
+            'cur': Field('deal_count7', convert=currency),
+        },
+        'parse_currency_order': {
+            'market': Field('deal_place4', convert=choice(MARKETS)),
+            'date': Field('curs_datebeg6', convert=timestamp),
+            'isin': Field('NameBeg6', convert=lambda value: value.strip()[:3]),
+            'direction': Field('currency_ISO6'),
+            'quantity': Field('NameEnd6', convert=integer),
+            'price': Field('deal_count4', convert=float),
+            'sum': Field('currency_price4', convert=float),
+            'cur': Field('deal_price4', convert=currency),
+        },
+        'parse_transfer': {
+            'oper_type': Field('operation_type'),
+            'comment': Field('notes1', convert=str.lower, default=''),
+            'date': Field('debt_type4', convert=timestamp),
+            'sum': Field('debt_date4', convert=float),
+            'cur': Field('decree_amount2', convert=currency),
+        },
+    }
 
-    @staticmethod
-    def parse_record(record):
-        date = record.attrib['debt_type4']
-        cur_code = record.attrib['decree_amount2']
-        if cur_code == 'RUR':
-            cur_code = 'RUB'
-        volume = record.attrib.get('debt_date4')
-        time = datetime.strptime(date, '%Y-%m-%dT%H:%M:%S')
-        return time, float(volume), cur_code
-
-    def parse(self, content, test=True):
-        root = etree.fromstring(content)
-        items = []
-
-        # orders section
-        collection = self.get(root, 'Tablix_b9')
-        try:
-            collection = self.get_child(collection, 'Подробности9_Collection')
-        except ValueError:
-            collection = []
-        for record in collection:
-            cur = record.attrib['deal_count7']
-            if cur == 'RUR':
-                cur = 'RUB'
-
-            quantity = int(float(record.attrib['NameEnd9']))
-            if record.attrib['currency_ISO9'] != 'Покупка':
-                quantity = -quantity
-
-            isin = record.attrib['NameBeg9'].strip().split(',')[-1].strip()
-            data = {
-                'market': self.MARKETS[record.attrib['deal_place7']],
-                'date': datetime.strptime(record.attrib['curs_datebeg9'],
-                                          '%Y-%m-%dT%H:%M:%S'),
-                'isin': isin,
-                'quantity': quantity,
-                'price': float(record.attrib['deal_price7']),
-                'sum': float(record.attrib['currency_paym7']),
-                'cur': cur,
-                **self.portfolio,
-            }
-
-            security = SecuritiesManager.get(isin=isin, first=True)
-            if not security:
-                security = QuotesLoader.get_securities_data(isin)
-                SecuritiesManager.upsert(security)
-
-            security_type = security['type']
-            if security_type == 'Bond':
-                faceValue = security['faceValue']
-                data['price'] = faceValue * data['price'] / 100
-            elif security_type not in ('Stock', 'Etf',):
-                raise ValueError(security_type)
-
-            if OrdersManager.get_first(**data) is not None:
-                continue
-
-            if test:
-                items.append(Order(**data))
-            else:
-                if 'upserted' in OrdersManager.upsert(data):
-                    items.append(Order(**data))
-
-        # currency orders section
-        try:
-            collection = self.get(root, 'Tablix_b10',
-                                  'Подробности6_Collection')
-        except ValueError:
-            collection = []
-        for record in collection:
-            cur = record.attrib['deal_price4']
-            if cur == 'RUR':
-                cur = 'RUB'
-
-            quantity = int(float(record.attrib['NameEnd6']))
-            if record.attrib['currency_ISO6'] != 'Покупка':
-                quantity = -quantity
-
-            data = {
-                'cur': cur,
-                'date': datetime.strptime(record.attrib['curs_datebeg6'],
-                                         '%Y-%m-%dT%H:%M:%S'),
-                'isin': record.attrib['NameBeg6'].strip()[:3],
-                'quantity': quantity,
-                'price': float(record.attrib['deal_count4']),
-                'sum': float(record.attrib['currency_price4']),
-                'market': self.MARKETS[record.attrib['deal_place4']],
-                **self.portfolio,
-            }
-            if OrdersManager.get_first(**data) is not None:
-                continue
-
-            if test:
-                items.append(Order(**data))
+    def parse_order(self, values):
+        if values['direction'] != 'Покупка':
+            values['quantity'] = -values['quantity']
+        values['price'] = self.get_price(values['isin'], values['price'])
+        return OrdersManager, self.get_order(values)
+
+    def parse_currency_order(self, values):
+        if values['direction'] != 'Покупка':
+            values['quantity'] = -values['quantity']
+        return OrdersManager, self.get_order(values)
+
+    def parse_transfer(self, values):
+        oper_type = values['oper_type']
+        comment = values['comment']
+
+        if (oper_type == 'Зачисление денежных средств' or
+                oper_type == 'Дивиденды' or oper_type == 'Купонный доход'):
+            if any(word in comment for word in ('купон', 'dividend',
+                                                'дивиденд', 'куп. дох.')):
+                manager = DividendManager
+            elif not comment or 'перечисление денежных средств' in comment:
+                manager = MoneyManager
             else:
-                if 'upserted' in OrdersManager.upsert(data):
-                    items.append(Order(**data))
-
-        # money transfer section
-        collection = self.get(root, 'Tablix_b4', 'DDS_place_Collection',
-                              'DDS_place', 'Подробности16_Collection')
-        for record in collection:
-            oper_type = record.attrib['operation_type'].strip()
-            comment = record.attrib.get('notes1', '').lower()
-
-            time, volume, cur_code = self.parse_record(record)
-            if (oper_type == 'Зачисление денежных средств' or
-                    oper_type == 'Дивиденды' or oper_type == 'Купонный доход'):
-                if any(word in comment for word in ('купон', 'dividend',
-                                                    'дивиденд', 'куп. дох.')):
-                    manager = DividendManager
-                    model = Dividend
-                elif not comment or 'перечисление денежных средств' in comment:
-                    manager = MoneyManager
-                    model = Money
-                else:
-                    raise ValueError(comment)
-            elif oper_type == 'Вознаграждение Брокера':
-                manager = CommissionManager
-                model = Commission
-                volume = abs(volume)
-            else:
-                if oper_type not in (
-                        'Сальдо расчётов по сделкам с ценными бумагами',
-                        'Сальдо расчётов по сделкам с иностранной валютой'):
-                    raise ValueError(oper_type)
-                continue
-
-            data = {
-                'sum': volume,
-                'comment': comment,
-                'cur': cur_code,
-                'date': time,
-                **self.portfolio,
-            }
+                raise ValueError(comment)
+        elif oper_type == 'Вознаграждение Брокера':
+            manager = CommissionManager
+            values['sum'] = abs(values['sum'])
+        else:
+            if oper_type not in (
+                    'Сальдо расчётов по сделкам с ценными бумагами',
+                    'Сальдо расчётов по сделкам с иностранной валютой'):
+                raise ValueError(oper_type)
+            return None
 
-            if test:
-                if manager.get_first(**data) is None:
-                    items.append(model(**data))
-            else:
-                if 'upserted' in manager.upsert(data):
-                    item = model(**data)
-                    items.append(item)
-        return items
+        return manager, self.get_transfer(values)
 
 
 PARSERS = {
@@ -355,6 +377,36 @@ PARSERS = {
 }
 
 
-def parse(content, broker, test=True):
-    parser = PARSERS[broker](1)
-    return parser.parse(content, test=test)
+def detect_broker(content):
+    # the broker of the first record collection of the report
+    path = []
+    for event, element in etree.iterparse(Parser.get_source(content),
+                                          ('start', 'end')):
+        if event == 'end':
+            path.pop()
+            continue
+        path.append(Parser.local_name(element.tag))
+        for broker, parser in PARSERS.items():
+            if parser.get_section(path) is not None:
+                return broker
+    raise ValueError('unknown report')
+
+
+def parse(content, broker, test=True, portfolio=1, progress=None,
+          collect=None):
+    parser = PARSERS[broker](portfolio)
+    with SnapshotManager.deferred():
+        return parser.parse(content, test=test, progress=progress,
+                            collect=collect)
+
+
+def parse_file(path, broker, test=True, portfolio=1, progress=None,
+               collect=None):
+    # progress gets the read share of the file
+    size = os.path.getsize(path) or 1
+    with open(path, 'rb') as f:
+        def read():
+            progress(min(f.tell() / size, 1))
+        return parse(f, broker, test=test, portfolio=portfolio,
+                     progress=read if progress is not None else None,
+                     collect=collect)
@@ -1,16 +1,23 @@
 import builtins
+import math
 from collections import defaultdict
 from datetime import datetime, timedelta
+from itertools import chain
 
+import numpy as np
 from tabulate import tabulate
 
+from portfolio.archive import ArchiveQuotes
 from portfolio.base import (
     TimeRange, Value, ValueList, date_to_key, key_to_date, sround)
-from portfolio.config import CBR_RATE, CBR_BASE_RATE
+from portfolio.config import CBR_RATE, CBR_BASE_RATE, SNAPSHOT_DELAY
+from portfolio.ledger import Ledger
 from portfolio.loaders import QuotesLoader
 from portfolio.managers import (
-    QuotesManager, OrdersManager, MoneyManagerCached, SecuritiesManager,
-    Order, Money, Commission, Dividend, DividendManager, CommissionManager)
+    CandlesManager, QuotesManager, MoneyManager, SecuritiesManager,
+    Order, Money, Commission, Dividend, DividendManager, CommissionManager,
+    SnapshotManager)
+from portfolio.prices import live_prices
 
 
 class Portfolio:
@@ -37,9 +44,15 @@ class Portfolio:
         'je00b5bcw814': 'ru000a1025v3',
     }
 
+    PYTHON = 'python'
+    NUMPY = 'numpy'
+    ENGINES = (PYTHON, NUMPY, )
+    ENGINE = NUMPY
+
     def __init__(self, portfolio_id, broker_id=None):
         self.portfolio_id = portfolio_id
         self.broker_id = broker_id
+        self._ledger = None
 
     def chart(self, start_date, end_date, currency=RUB):
         time_range = TimeRange(start_date, end_date)
@@ -53,7 +66,7 @@ class Portfolio:
                                                       currency=currency)
 
         funds_cash_data = self._get_history(
-            MoneyManagerCached, TimeRange(None, time_range.end_time), currency)
+            MoneyManager, TimeRange(None, time_range.end_time), currency)
         funds_data = [self.get_fund_history(funds_cash_data, fund, time_range,
                                             currency=currency)
                       for fund in self.FUNDS]
@@ -69,46 +82,105 @@ class Portfolio:
 
         self.show_charts()
 
-    def get_value_history(self, time_range, currency=RUB):
-        value = ValueList('value')
-        prev_price = {}
-        portfolio = defaultdict(int)
-        operations = defaultdict(list)
-        orders_range = TimeRange(None, time_range.end_time)
-        stock_orders = OrdersManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        money_orders = MoneyManagerCached.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        dividend_orders = DividendManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        commission_orders = CommissionManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        all_orders = money_orders + dividend_orders + stock_orders
-        all_orders += commission_orders
-        all_orders.sort(key=lambda x: x[0])
-
-        cur_range = TimeRange(key_to_date(all_orders[0].date),
-                              time_range.end_time)
-        usd = QuotesManager.get_quotes(self.USD, cur_range)
-        eur = QuotesManager.get_quotes(self.EUR, cur_range)
-        dates = self.get_dates(cur_range)
+    def get_ledger(self, time_range):
+        # one ledger load is shared by all the methods called on the instance
+        ledger = self._ledger
+        if ledger is not None and not ledger.is_current():
+            ledger = None
+        if ledger is None or not ledger.covers(time_range):
+            ledger_range = ledger.union(time_range) if ledger else time_range
+            ledger = self._ledger = Ledger(self.portfolio_id, self.broker_id,
+                                           ledger_range)
+        return ledger.slice(time_range)
+
+    def get_value_history(self, time_range, currency=RUB, engine=None):
+        engine = engine or self.ENGINE
+        if engine not in self.ENGINES:
+            raise ValueError(engine)
+
+        kind = SnapshotManager.VALUE
+        value, snapshot, limit = self._get_snapshot(kind, 'value', time_range,
+                                                    currency)
+        state = {'portfolio': {}, 'prices': {}}
+        start_time = None
+        if snapshot:
+            state = snapshot.state
+            start_time = key_to_date(snapshot.date) + timedelta(days=1)
+            if start_time > time_range.end_time:
+                return value
+
+        ledger = self.get_ledger(TimeRange(start_time, time_range.end_time))
+        cur_range = TimeRange(
+            start_time or key_to_date(ledger.events[0].date),
+            time_range.end_time)
 
-        for order in all_orders:
-            operations[order.date].append(order)
-            if isinstance(order, Order):
-                quantity = order.quantity
-                portfolio[order.isin] += quantity
-                if portfolio[order.isin] < 0:
-                    raise ValueError(order.isin)
+        isins = self.get_instruments(ledger, state['portfolio'])
+        quotes = QuotesManager.prefetch(isins, cur_range)
 
-        portfolio = defaultdict(int)
-        for date in dates:
-            day_orders = operations[date]
-            self._update_portfolio_dict(portfolio, day_orders)
+        if engine == self.NUMPY:
+            values, snapshots = self._get_value_history_numpy(
+                ledger, quotes, cur_range, currency, state, limit)
+        else:
+            values, snapshots = self._get_value_history_python(
+                ledger, quotes, cur_range, currency, state, limit)
+        self._extend_history(value, values, time_range)
+        SnapshotManager.save(kind, currency, self.portfolio_id,
+                             self.broker_id, snapshots)
+        return value
 
+    def _get_snapshot(self, kind, title, time_range, currency, values=True):
+        # the last snapshot and the stored values of the range, without the
+        # values the last snapshot before the range start
+        history = ValueList(title)
+        limit = date_to_key(datetime.now() - timedelta(days=SNAPSHOT_DELAY))
+        limit = min(limit, time_range.end)
+        last = limit
+        if not values and time_range.start is not None:
+            last = min(limit, date_to_key(
+                time_range.start_time - timedelta(days=1)))
+        snapshot = SnapshotManager.get_last(
+            kind, currency, self.portfolio_id, self.broker_id,
+            key_to_date(last))
+        if snapshot and values:
+            values_range = TimeRange(time_range.start_time,
+                                     key_to_date(snapshot.date))
+            values = SnapshotManager.get_values(
+                kind, currency, self.portfolio_id, self.broker_id,
+                values_range)
+            self._extend_history(history, values, time_range)
+        return history, snapshot, limit
+
+    @staticmethod
+    def _extend_history(history, values, time_range):
+        for date, day_sum in values:
             if time_range.start is not None and date < time_range.start:
                 continue
+            day_value = Value()
+            day_value.key = date
+            day_value.value = day_sum
+            history.append(day_value)
+
+    def get_instruments(self, ledger, holdings=None):
+        isins = {self.USD: None, self.EUR: None}
+        for isin in chain(holdings or (), ledger.orders_isins()):
+            isin = self.CHANGES.get(isin, isin)
+            if isin not in self.CURRENCIES:
+                isins[isin] = None
+        return list(isins)
+
+    def _get_value_history_python(self, ledger, quotes, cur_range, currency,
+                                  state, limit):
+        values = []
+        snapshots = []
+        prev_price = dict(state['prices'])
+
+        usd = quotes[self.USD]
+        eur = quotes[self.EUR]
+        dates = self.get_dates(cur_range)
 
+        self._check_quantities(ledger, state['portfolio'])
+        for date, portfolio in ledger.iter_positions(dates,
+                                                     state['portfolio']):
             if date in usd:
                 prev_price[self.USD] = usd[date]
             if date in eur:
@@ -127,7 +199,7 @@ class Portfolio:
                 else:
                     if isin in self.CHANGES:
                         isin = self.CHANGES[isin]
-                    candles = QuotesManager.get_quotes(isin, cur_range)
+                    candles = quotes[isin]
                     if date in candles:
                         c1 = candles[date]
                         prev_price[isin] = c1
@@ -158,27 +230,202 @@ class Portfolio:
             else:
                 c3 = 1
 
-            day_value = Value()
-            day_value.key = date
-            day_value.value = portfolio_sum / c3
-            value.append(day_value)
-        return value
-
-    def _update_portfolio_dict(self, portfolio, orders):
-        for order in orders:
-            cur = order.cur
-            sum = order.sum
+            day_sum = portfolio_sum / c3
+            values.append((date, day_sum))
+            if date <= limit:
+                snapshots.append((date, day_sum, {
+                    'portfolio': dict(portfolio),
+                    'prices': dict(prev_price),
+                }))
+        return values, snapshots
+
+    def _check_quantities(self, ledger, holdings):
+        portfolio = defaultdict(int, {
+            isin: quantity for isin, quantity in holdings.items()
+            if isin not in self.CURRENCIES})
+        for order in ledger.orders:
+            portfolio[order.isin] += order.quantity
+            if portfolio[order.isin] < 0:
+                raise ValueError(order.isin)
+
+    def _get_value_history_numpy(self, ledger, quotes, cur_range, currency,
+                                 state, limit):
+        usd = quotes[self.USD]
+        eur = quotes[self.EUR]
+        dates = list(self.get_dates(cur_range))
+        rows = {date: row for row, date in enumerate(dates)}
+
+        self._check_quantities(ledger, state['portfolio'])
+
+        # per key delta stream in the order Ledger.update_positions applies
+        # it, keys are kept in the order they appear in the portfolio dict
+        deltas = {key: [(0, quantity)]
+                  for key, quantity in state['portfolio'].items()}
+        for order in ledger.events:
+            row = rows[order.date]
             if isinstance(order, Order):
-                assert sum > 0
-                isin = order.isin
-                quantity = order.quantity
-                portfolio[isin] += quantity
-                portfolio[cur] -= quantity / abs(quantity) * sum
-            if isinstance(order, (Money, Dividend)):
-                portfolio[cur] += sum
-            if isinstance(order, Commission):
-                assert sum > 0
-                portfolio[cur] -= sum
+                deltas.setdefault(order.isin, []).append(
+                    (row, order.quantity))
+                sign = order.quantity / abs(order.quantity)
+                deltas.setdefault(order.cur, []).append(
+                    (row, -(sign * order.sum)))
+            elif isinstance(order, (Money, Dividend)):
+                deltas.setdefault(order.cur, []).append((row, order.sum))
+            elif isinstance(order, Commission):
+                deltas.setdefault(order.cur, []).append((row, -order.sum))
+
+        positions = {}
+        first_rows = {}
+        for key, items in deltas.items():
+            event_rows = np.array([item[0] for item in items])
+            cumulative = np.cumsum(
+                np.array([item[1] for item in items], dtype=np.float64))
+            index = np.searchsorted(event_rows, np.arange(len(dates)),
+                                    side='right') - 1
+            positions[key] = np.where(index >= 0, cumulative[index], 0)
+            first_rows[key] = event_rows[0]
+
+        prev_price = state['prices']
+        rates = {
+            self.USD: self._get_price_vector(
+                usd, dates, prev=prev_price.get(self.USD)),
+            self.EUR: self._get_price_vector(
+                eur, dates, prev=prev_price.get(self.EUR)),
+        }
+
+        prices = {}
+        price_rows = {}
+        for key in positions:
+            isin = self.CHANGES.get(key, key)
+            if isin in self.CURRENCIES or isin in prices:
+                continue
+            price_rows[isin] = min(first_rows[alias] for alias in positions
+                                   if self.CHANGES.get(alias, alias) == isin)
+            candles = quotes[isin]
+            prices[isin] = self._get_price_vector(
+                candles, dates, first_row=price_rows[isin],
+                prev=prev_price.get(isin))
+
+        total = np.zeros(len(dates))
+        for key, quantity in positions.items():
+            if key == self.RUB:
+                position = quantity
+            elif key in rates:
+                position = rates[key] * quantity
+            else:
+                isin = self.CHANGES.get(key, key)
+                security = SecuritiesManager.get_data(isin=isin)
+                cur = security['currency']
+                if cur == self.RUB:
+                    position = prices[isin] * quantity
+                elif cur in rates:
+                    position = prices[isin] * rates[cur] * quantity
+                else:
+                    raise ValueError(cur)
+            position[:first_rows[key]] = 0
+            total += position
+
+        if currency in rates:
+            total /= rates[currency]
+
+        values = list(zip(dates, total.tolist()))
+        snapshots = []
+        stored = sum(1 for date in dates if date <= limit)
+        if stored:
+            positions = {key: quantity[:stored].tolist()
+                         for key, quantity in positions.items()}
+            prices.update(rates)
+            prices = {isin: vector[:stored].tolist()
+                      for isin, vector in prices.items()}
+            for row, (date, day_sum) in enumerate(values[:stored]):
+                snapshots.append((date, day_sum, {
+                    'portfolio': {
+                        key: quantity[row]
+                        for key, quantity in positions.items()
+                        if first_rows[key] <= row},
+                    'prices': {
+                        isin: vector[row] for isin, vector in prices.items()
+                        if price_rows.get(isin, 0) <= row and
+                        not math.isnan(vector[row])},
+                }))
+        return values, snapshots
+
+    @staticmethod
+    def _get_price_vector(quotes, dates, first_row=0, prev=None):
+        # forward-filled prices, the values before first_row are left
+        # undefined just like prev_price in the python engine
+        if isinstance(quotes, ArchiveQuotes):
+            prices = quotes.take(dates)
+            prices[:first_row] = np.nan
+        else:
+            prices = np.full(len(dates), np.nan)
+            for row, date in enumerate(dates[first_row:], first_row):
+                if date in quotes:
+                    prices[row] = quotes[date]
+        if first_row < len(prices) and np.isnan(prices[first_row]):
+            if prev is not None:
+                prices[first_row] = prev
+            elif quotes:
+                prices[first_row] = quotes[next(iter(quotes))]
+        index = np.where(np.isnan(prices), 0, np.arange(len(prices)))
+        np.maximum.accumulate(index, out=index)
+        return prices[index]
+
+    def get_intraday_history(self, date, currency=RUB,
+                             interval=QuotesLoader.HOUR):
+        day = TimeRange(date, date)
+        ledger = self.get_ledger(TimeRange(None, date))
+        portfolio = ledger.positions(day.end)
+
+        holdings = {isin: quantity for isin, quantity in portfolio.items()
+                    if quantity}
+        isins = self.get_instruments(ledger.slice(day), holdings)
+        candles = CandlesManager.prefetch(isins, day, interval)
+        times = np.unique(np.concatenate([
+            candle_times for candle_times, _ in candles.values()]))
+
+        # the prices between the candles and before the first one of the day
+        previous = TimeRange(date - timedelta(days=7),
+                             date - timedelta(days=1))
+        prices = {}
+        for isin, (candle_times, candle_prices) in candles.items():
+            closes = QuotesManager.get_quotes(isin, previous)
+            prev = next(reversed(closes.values()), np.nan)
+            rows = np.searchsorted(candle_times, times, side='right') - 1
+            if len(candle_prices):
+                column = candle_prices[np.maximum(rows, 0)]
+                prices[isin] = np.where(rows >= 0, column, prev)
+            else:
+                prices[isin] = np.full(len(times), prev)
+
+        total = np.zeros(len(times))
+        for isin, quantity in portfolio.items():
+            if not quantity:
+                continue
+            if isin == self.RUB:
+                total += quantity
+            elif isin in self.CURRENCIES:
+                total += prices[isin] * quantity
+            else:
+                isin = self.CHANGES.get(isin, isin)
+                cur = SecuritiesManager.get_data(isin=isin)['currency']
+                if cur == self.RUB:
+                    total += prices[isin] * quantity
+                elif cur in self.CURRENCIES:
+                    total += prices[isin] * prices[cur] * quantity
+                else:
+                    raise ValueError(cur)
+
+        if currency != self.RUB:
+            total /= prices[currency]
+        return times, np.round(total, 2)
+
+    def get_prices(self, portfolio):
+        isins = [self.USD, self.EUR]
+        for isin, quantity in portfolio.items():
+            if quantity and isin not in self.CURRENCIES:
+                isins.append(self.CHANGES.get(isin, isin))
+        return live_prices.get_many(isins)
 
     def get_value(self):
         usd_based = (
@@ -188,26 +435,14 @@ class Portfolio:
 
         bonds_based = (self.FXMM, self.FXRB, )
 
-        usd = QuotesLoader.current(self.USD)
-        eur = QuotesLoader.current(self.EUR)
-
         by_cur = defaultdict(int)
 
-        orders_range = TimeRange(None, datetime.now())
-        stock_orders = OrdersManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        money_orders = MoneyManagerCached.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        dividend_orders = DividendManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        commission_orders = CommissionManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        all_orders = money_orders + dividend_orders + stock_orders
-        all_orders += commission_orders
-        all_orders.sort(key=lambda x: x[0])
-
-        portfolio = defaultdict(int)
-        self._update_portfolio_dict(portfolio, all_orders)
+        ledger = self.get_ledger(TimeRange(None, datetime.now()))
+        portfolio = ledger.positions()
+
+        prices = self.get_prices(portfolio)
+        usd = prices[self.USD]
+        eur = prices[self.EUR]
 
         portfolio_sum = 0
         active_sum = 0
@@ -228,7 +463,7 @@ class Portfolio:
             else:
                 if isin in self.CHANGES:
                     isin = self.CHANGES[isin]
-                c1 = QuotesLoader.current(isin)
+                c1 = prices[isin]
 
                 security = SecuritiesManager.get_data(isin=isin)
                 cur = security['currency']
@@ -286,26 +521,12 @@ class Portfolio:
         print(state)
 
     def get_state(self, total=True):
-        usd = QuotesLoader.current(self.USD)
-        eur = QuotesLoader.current(self.EUR)
-        usd = usd or 0
-        eur = eur or 0
-
-        orders_range = TimeRange(None, datetime.now())
-        stock_orders = OrdersManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        money_orders = MoneyManagerCached.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        dividend_orders = DividendManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        commission_orders = CommissionManager.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-        all_orders = money_orders + dividend_orders + stock_orders
-        all_orders += commission_orders
-        all_orders.sort(key=lambda x: x[0])
-
-        portfolio = defaultdict(int)
-        self._update_portfolio_dict(portfolio, all_orders)
+        ledger = self.get_ledger(TimeRange(None, datetime.now()))
+        portfolio = ledger.positions()
+
+        prices = self.get_prices(portfolio)
+        usd = prices[self.USD] or 0
+        eur = prices[self.EUR] or 0
 
         state_asset = []
         asset_sum = 0
@@ -327,7 +548,7 @@ class Portfolio:
             else:
                 if isin in self.CHANGES:
                     isin = self.CHANGES[isin]
-                c1 = QuotesLoader.current(isin)
+                c1 = prices[isin]
 
                 security = SecuritiesManager.get_data(isin=isin)
                 sec_cur = security['currency']
@@ -369,11 +590,27 @@ class Portfolio:
         print(state)
 
     def get_cbr_history(self, time_range, currency=RUB):
-        money_range = TimeRange(None, time_range.end_time)
-        money_orders = MoneyManagerCached.get_data(
-            self.portfolio_id, money_range, broker_id=self.broker_id)
-        cur_range = TimeRange(key_to_date(money_orders[0].date),
-                              time_range.end_time)
+        # the deposit starts accruing from time_range.start. The snapshots
+        # store the full history, a range resumes the sum of the last one
+        # before its start with nothing accrued and extends them on the way
+        kind = SnapshotManager.CBR
+        full = time_range.start is None
+        cash, snapshot, limit = self._get_snapshot(kind, 'cbr', time_range,
+                                                   currency, values=full)
+        state = {'sum': 0, 'prev': 0, 'proc': 0, 'rate': CBR_BASE_RATE,
+                 'prices': {}}
+        start_time = None
+        if snapshot:
+            state = snapshot.state
+            start_time = key_to_date(snapshot.date) + timedelta(days=1)
+            if start_time > time_range.end_time:
+                return cash
+
+        money_range = TimeRange(start_time, time_range.end_time)
+        money_orders = self.get_ledger(money_range).money
+        cur_range = TimeRange(
+            start_time or key_to_date(money_orders[0].date),
+            time_range.end_time)
         usd = QuotesManager.get_quotes(self.USD, cur_range)
         eur = QuotesManager.get_quotes(self.EUR, cur_range)
         dates = self.get_dates(cur_range)
@@ -390,38 +627,62 @@ class Portfolio:
                 raise ValueError(order.cur)
             operations[order.date].append(c * order.sum)
 
-        prev_price = {}
-        cash = ValueList('cbr')
-        rate = CBR_BASE_RATE
-        s = prev = proc = 0
+        prev_price = dict(state['prices'])
+        snapshots = []
+        rate = state['rate']
+        s, prev, proc = state['sum'], state['prev'], state['proc']
+        range_prev = range_proc = 0
         for date in dates:
             s += builtins.sum(operations[date])
             rate = CBR_RATE.get(date, rate)
             pr = rate / 100 / 365.5
             proc += proc * pr
             proc += prev * pr
+            prev = s
 
             if date in usd:
                 prev_price[self.USD] = usd[date]
             if date in eur:
                 prev_price[self.EUR] = eur[date]
 
-            if time_range.start is not None and date < time_range.start:
+            in_range = full or date >= time_range.start
+            stored = date <= limit
+            if not in_range and not stored:
                 continue
 
             if currency == self.USD:
-                c3 = usd.get(date, prev_price[self.USD])
+                c3 = usd.get(date, prev_price.get(self.USD))
             elif currency == self.EUR:
-                c3 = eur.get(date, prev_price[self.EUR])
+                c3 = eur.get(date, prev_price.get(self.EUR))
             else:
                 c3 = 1
+            if c3 is None:
+                # no price of the currency yet
+                if in_range:
+                    raise KeyError(currency)
+                continue
+
+            value = (s + proc) / c3
+            if stored:
+                snapshots.append((date, value, {
+                    'sum': s, 'prev': prev, 'proc': proc, 'rate': rate,
+                    'prices': dict(prev_price),
+                }))
+            if not in_range:
+                continue
+
+            if not full:
+                range_proc += range_proc * pr
+                range_proc += range_prev * pr
+                range_prev = s
+                value = (s + range_proc) / c3
 
             day_value = Value()
             day_value.key = date
-            day_value.value = (s + proc) / c3
+            day_value.value = value
             cash.append(day_value)
-
-            prev = s
+        SnapshotManager.save(kind, currency, self.portfolio_id,
+                             self.broker_id, snapshots)
         return cash
 
     def get_dates(self, time_range):
@@ -431,32 +692,47 @@ class Portfolio:
             date += timedelta(days=1)
 
     def _get_history(self, manager, time_range, currency):
-        cash = ValueList(manager.collection)
-        orders_range = TimeRange(None, time_range.end_time)
-        orders = manager.get_data(self.portfolio_id, orders_range,
-                                  broker_id=self.broker_id)
-        money_orders = MoneyManagerCached.get_data(
-            self.portfolio_id, orders_range, broker_id=self.broker_id)
-
-        if not orders:
+        kind = manager.collection
+        cash, snapshot, limit = self._get_snapshot(kind, kind, time_range,
+                                                   currency)
+        if snapshot:
+            start_time = key_to_date(snapshot.date) + timedelta(days=1)
+            if start_time > time_range.end_time:
+                return cash
+            dates_range = cur_range = TimeRange(start_time,
+                                                time_range.end_time)
+            orders = manager.get_daily_sums(self.portfolio_id, dates_range,
+                                            self.broker_id)
+            state = snapshot.state
+        else:
+            orders_range = TimeRange(None, time_range.end_time)
+            orders = manager.get_daily_sums(self.portfolio_id, orders_range,
+                                            self.broker_id)
+            money_orders = orders
+            if manager is not MoneyManager:
+                money_orders = MoneyManager.get_daily_sums(
+                    self.portfolio_id, orders_range, self.broker_id)
+
+            if not orders:
+                dates_range = TimeRange(
+                    key_to_date(max(money_orders[0].date, time_range.start)),
+                    time_range.end_time)
+                dates = self.get_dates(dates_range)
+                for date in dates:
+                    day_value = Value()
+                    day_value.key = date
+                    day_value.value = float(0)
+                    cash.append(day_value)
+                return cash
+
             dates_range = TimeRange(
-                key_to_date(max(money_orders[0].date, time_range.start)),
+                key_to_date(min(orders[0].date, money_orders[0].date)),
                 time_range.end_time)
-            dates = self.get_dates(dates_range)
-            for date in dates:
-                day_value = Value()
-                day_value.key = date
-                day_value.value = float(0)
-                cash.append(day_value)
-            return cash
-
-        dates_range = TimeRange(
-            key_to_date(min(orders[0].date, money_orders[0].date)),
-            time_range.end_time)
+            cur_range = TimeRange(key_to_date(orders[0].date),
+                                  time_range.end_time)
+            state = {'sum': 0, 'prices': {}}
         dates = self.get_dates(dates_range)
 
-        cur_range = TimeRange(key_to_date(orders[0].date),
-                              time_range.end_time)
         usd = QuotesManager.get_quotes(self.USD, cur_range)
         eur = QuotesManager.get_quotes(self.EUR, cur_range)
 
@@ -466,8 +742,9 @@ class Portfolio:
                 raise ValueError(order.cur)
             operations[order.date].append(order)
 
-        prev_price = {}
-        s = 0
+        prev_price = dict(state['prices'])
+        snapshots = []
+        s = state['sum']
         for date in dates:
             if date in usd:
                 prev_price[self.USD] = usd[date]
@@ -489,6 +766,10 @@ class Portfolio:
                 day_sum += order.sum * c1 / c2
             s += day_sum
 
+            if date <= limit:
+                snapshots.append((date, float(s), {
+                    'sum': s, 'prices': dict(prev_price)}))
+
             if time_range.start and date < time_range.start:
                 continue
 
@@ -496,10 +777,12 @@ class Portfolio:
             day_value.key = date
             day_value.value = float(s)
             cash.append(day_value)
+        SnapshotManager.save(kind, currency, self.portfolio_id,
+                             self.broker_id, snapshots)
         return cash
 
     def get_cash_history(self, time_range, currency=RUB):
-        return self._get_history(MoneyManagerCached, time_range, currency)
+        return self._get_history(MoneyManager, time_range, currency)
 
     def get_dividend_history(self, time_range, currency=RUB):
         return self._get_history(DividendManager, time_range, currency)
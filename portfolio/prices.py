@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from portfolio.config import (
+    PRICES_CLOSED_TTL, PRICES_STALE, PRICES_TTL, PRICES_WORKERS)
+from portfolio.loaders import QuotesLoader
+
+
+LivePrice = namedtuple('LivePrice', ['price', 'trading', 'expires', 'stale'])
+
+
+class LivePrices:
+    def __init__(self, loader=QuotesLoader, ttl=PRICES_TTL,
+                 closed_ttl=PRICES_CLOSED_TTL, stale=PRICES_STALE,
+                 workers=PRICES_WORKERS):
+        self.loader = loader
+        self.ttl = ttl
+        self.closed_ttl = closed_ttl
+        self.stale = stale
+        self._lock = threading.Lock()
+        self._prices = {}
+        # isin -> future of the request in flight, shared by all the callers
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix='prices')
+
+    def get(self, isin):
+        return self.get_many((isin, ))[isin]
+
+    def get_many(self, isins):
+        result = {}
+        futures = {}
+        now = time.monotonic()
+        with self._lock:
+            for isin in dict.fromkeys(isins):
+                item = self._prices.get(isin)
+                if item is not None and now < item.stale:
+                    result[isin] = item.price
+                    if item.expires <= now:
+                        # serve the stale price, refresh it in background
+                        self._request(isin)
+                else:
+                    futures[isin] = self._request(isin)
+
+        for isin, future in futures.items():
+            result[isin] = future.result()
+        return result
+
+    def refresh(self, isins):
+        # reloads the prices regardless of their age, returns the cached
+        # items to let the caller know which instruments are trading, None
+        # for the ones that failed to load
+        with self._lock:
+            futures = {isin: self._request(isin)
+                       for isin in dict.fromkeys(isins)}
+        result = {}
+        for isin, future in futures.items():
+            if future.exception() is None:
+                result[isin] = self._prices.get(isin)
+            else:
+                result[isin] = None
+        return result
+
+    def set(self, isin, price, trading=True):
+        if price is None:
+            return
+        now = time.monotonic()
+        expires = now + (self.ttl if trading else self.closed_ttl)
+        with self._lock:
+            self._prices[isin] = LivePrice(price, trading, expires,
+                                           expires + self.stale)
+
+    def clear(self, isin=None):
+        with self._lock:
+            if isin is None:
+                self._prices.clear()
+            else:
+                self._prices.pop(isin, None)
+
+    def _request(self, isin):
+        future = self._pending.get(isin)
+        if future is None:
+            future = self._executor.submit(self._load, isin)
+            self._pending[isin] = future
+        return future
+
+    def _load(self, isin):
+        try:
+            price, trading = self.loader.current_status(isin)
+            self.set(isin, price, trading)
+            return price
+        finally:
+            with self._lock:
+                self._pending.pop(isin, None)
+
+
+live_prices = LivePrices()
@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+from portfolio.config import (
+    REFRESH_CANDLES_INTERVAL, REFRESH_CLOSED_INTERVAL,
+    REFRESH_HOLDINGS_INTERVAL, REFRESH_INTERVAL)
+from portfolio.managers import (
+    OrdersManager, QuotesManager, SecuritiesManager)
+from portfolio.portfolio import Portfolio
+from portfolio.prices import live_prices
+
+
+logger = logging.getLogger(__name__)
+
+
+class QuoteRefresher(threading.Thread):
+    def __init__(self, prices=live_prices, interval=REFRESH_INTERVAL,
+                 closed_interval=REFRESH_CLOSED_INTERVAL,
+                 candles_interval=REFRESH_CANDLES_INTERVAL,
+                 holdings_interval=REFRESH_HOLDINGS_INTERVAL):
+        super().__init__(name='quote-refresher', daemon=True)
+        self.prices = prices
+        self.interval = interval
+        self.closed_interval = closed_interval
+        self.candles_interval = candles_interval
+        self.holdings_interval = holdings_interval
+        self._stop_event = threading.Event()
+        self._isins = []
+        self._holdings_due = 0
+        # isin -> monotonic time of the next price and candle reload
+        self._due = {}
+        self._candles_due = {}
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('Quotes refresh failed')
+            self._stop_event.wait(self.get_delay())
+
+    def get_delay(self):
+        now = time.monotonic()
+        due = [self._holdings_due, *self._due.values()]
+        return min(max(min(due) - now, 1), self.interval)
+
+    def get_isins(self):
+        isins = {Portfolio.USD: None, Portfolio.EUR: None}
+        for isin in OrdersManager.get_held_isins():
+            isins[Portfolio.CHANGES.get(isin, isin)] = None
+        return list(isins)
+
+    def tick(self):
+        now = time.monotonic()
+        if self._holdings_due <= now:
+            if SecuritiesManager.is_stale():
+                try:
+                    SecuritiesManager.refresh()
+                except Exception:
+                    logger.exception('Securities refresh failed')
+            self._isins = self.get_isins()
+            self._due = {isin: self._due.get(isin, 0) for isin in self._isins}
+            self._holdings_due = now + self.holdings_interval
+
+        due = [isin for isin in self._isins if self._due[isin] <= now]
+        if not due:
+            return
+
+        for isin, item in self.prices.refresh(due).items():
+            if item is None:
+                logger.warning('No live price of %s', isin)
+                self._due[isin] = now + self.interval
+                continue
+            if item.trading:
+                self._due[isin] = now + self.interval
+            else:
+                self._due[isin] = now + self.closed_interval
+
+            if not item.trading or isin in Portfolio.CURRENCIES:
+                continue
+            if self._candles_due.get(isin, 0) <= now:
+                try:
+                    QuotesManager.append_today(isin)
+                except Exception:
+                    logger.exception('No candles of %s', isin)
+                self._candles_due[isin] = now + self.candles_interval
+
+
+def start_refresher():
+    refresher = QuoteRefresher()
+    refresher.start()
+    return refresher
@@ -0,0 +1,104 @@
+import re
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+from portfolio.config import PARSER_DATE_CACHE_SIZE
+
+
+# declarative extraction of the broker report records: a field is read from
+# the first non-empty of its attribute aliases on the record or on the
+# element at its path below the record, then converted. A path ending with
+# [attr] selects the first element having a non-empty attr, the fields
+# sharing the path are read from the same element.
+
+REQUIRED = object()
+
+Field = namedtuple('Field', ['names', 'path', 'convert', 'default'],
+                   defaults=(None, str.strip, REQUIRED))
+
+CURRENCIES = {
+    'RUR': 'RUB',
+}
+
+
+def currency(value):
+    value = value.strip()
+    return CURRENCIES.get(value, value)
+
+
+def integer(value):
+    return int(float(value))
+
+
+def choice(mapping):
+    def convert(value):
+        try:
+            return mapping[value.strip()]
+        except KeyError:
+            raise ValueError(value) from None
+    return convert
+
+
+def date(format):
+    # the format covers the leading words of the value, the rows of a report
+    # share a few distinct values so the parsed dates are cached
+    words = len(format.split())
+
+    @lru_cache(maxsize=PARSER_DATE_CACHE_SIZE)
+    def convert(value):
+        return datetime.strptime(' '.join(value.split()[:words]), format)
+    return convert
+
+
+timestamp = date('%Y-%m-%dT%H:%M:%S')
+
+
+def get_namespace(tag):
+    return tag[:tag.index('}') + 1] if tag.startswith('{') else ''
+
+
+def compile_path(path, namespace):
+    predicate = None
+    match = re.fullmatch(r'(.*)\[(\w+)\]', path)
+    if match:
+        path, predicate = match.groups()
+    xpath = '/'.join(namespace + tag for tag in path.split('/'))
+    if predicate is None:
+        return lambda record: record.find(xpath)
+    return lambda record: next((element
+                                for element in record.iterfind(xpath)
+                                if element.get(predicate)), None)
+
+
+def compile_schema(fields, namespace=''):
+    # name -> Field into a function of the record returning name -> value
+    finders = {path: compile_path(path, namespace)
+               for path in {field.path for field in fields.values()}
+               if path is not None}
+    getters = [
+        (name, field.path,
+         (field.names, ) if isinstance(field.names, str) else field.names,
+         field.convert, field.default)
+        for name, field in fields.items()]
+
+    def extract(record):
+        elements = {path: find(record) for path, find in finders.items()}
+        elements[None] = record
+        values = {}
+        for name, path, names, convert, default in getters:
+            element = elements[path]
+            value = None
+            if element is not None:
+                for alias in names:
+                    value = element.get(alias)
+                    if value:
+                        break
+            if value:
+                values[name] = convert(value)
+            elif default is REQUIRED:
+                raise ValueError(f'{name} not found')
+            else:
+                values[name] = default
+        return values
+    return extract
@@ -0,0 +1,448 @@
+import json
+import pickle
+import sqlite3
+import threading
+from collections import namedtuple
+from copy import deepcopy
+from datetime import datetime
+from itertools import islice
+from operator import ge, gt, le, lt
+
+
+# embedded stand-ins for the pymongo client, database and collections with
+# the subset of the API DBManager uses: equality, $gt/$gte/$lt/$lte/$in
+# filters, inclusion and exclusion projections, sorts and $set/$inc/$push
+# updates
+
+BulkWriteResult = namedtuple('BulkWriteResult', [
+    'matched_count', 'modified_count', 'upserted_count', 'upserted_ids'])
+DeleteResult = namedtuple('DeleteResult', ['deleted_count'])
+InsertResult = namedtuple('InsertResult', ['inserted_ids'])
+
+# the immutable types of the field values, the others are copied
+SCALARS = {str, int, float, bool, bytes, datetime, type(None)}
+
+
+def compare(operator):
+    # like mongo, the missing, null and not comparable values never match
+    def check(value, arg):
+        if value is None or arg is None:
+            return False
+        try:
+            return operator(value, arg)
+        except TypeError:
+            return False
+    return check
+
+
+OPERATORS = {
+    '$gt': compare(gt),
+    '$gte': compare(ge),
+    '$lt': compare(lt),
+    '$lte': compare(le),
+    '$in': lambda value, arg: value in arg,
+}
+
+
+def is_operator(condition):
+    return isinstance(condition, dict) and condition and all(
+        key.startswith('$') for key in condition)
+
+
+def match(document, filters):
+    for field, condition in filters.items():
+        value = document.get(field)
+        if is_operator(condition):
+            for operator, arg in condition.items():
+                if operator not in OPERATORS:
+                    raise ValueError(operator)
+                if not OPERATORS[operator](value, arg):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(document, fields):
+    if not fields:
+        return copy(document)
+    included = [field for field, flag in fields.items() if flag]
+    if not included:
+        return copy({key: value for key, value in document.items()
+                     if key not in fields})
+    result = {field: document[field] for field in included
+              if field in document}
+    if fields.get('_id', 1) and '_id' in document:
+        result['_id'] = document['_id']
+    return copy(result)
+
+
+def copy(document):
+    # the stored documents are never shared with the callers
+    return {key: value if type(value) in SCALARS else deepcopy(value)
+            for key, value in document.items()}
+
+
+def sort_key(field):
+    def key(document):
+        value = document.get(field)
+        return (0, ) if value is None else (1, value)
+    return key
+
+
+def apply_update(document, update):
+    for operator, data in update.items():
+        if operator == '$set':
+            document.update(copy(data))
+        elif operator == '$inc':
+            for field, value in data.items():
+                document[field] = document.get(field, 0) + value
+        elif operator == '$push':
+            for field, values in data.items():
+                values = values['$each'] if is_operator(values) else [values]
+                document.setdefault(field, []).extend(values)
+        else:
+            raise ValueError(operator)
+    return document
+
+
+def new_document(filters, update):
+    document = {field: condition for field, condition in filters.items()
+                if not is_operator(condition)}
+    return apply_update(document, update)
+
+
+class Cursor:
+    def __init__(self, collection, filters, fields):
+        self.collection = collection
+        self.filters = filters
+        self.fields = fields
+        self.sort_fields = []
+        self.limit_count = 0
+
+    def sort(self, fields):
+        self.sort_fields = list(fields)
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def explain(self):
+        return self.collection.explain(self.filters, self.sort_fields)
+
+    def __iter__(self):
+        documents = self.collection.find_documents(
+            self.filters, self.sort_fields, self.limit_count)
+        if self.limit_count:
+            documents = islice(documents, self.limit_count)
+        for document in documents:
+            yield project(document, self.fields)
+
+
+class Collection:
+    def __init__(self, name):
+        self.name = name
+        self.indexes = {}
+        self._lock = threading.RLock()
+
+    def find(self, filters=None, fields=None):
+        return Cursor(self, filters or {}, fields)
+
+    def find_one(self, filters=None, fields=None):
+        return next(iter(self.find(filters, fields).limit(1)), None)
+
+    def count_documents(self, filters):
+        return sum(1 for _ in self.find_documents(filters, []))
+
+    def distinct(self, field, filters=None):
+        values = []
+        for document in self.find(filters, {field: 1}):
+            if field in document and document[field] not in values:
+                values.append(document[field])
+        return values
+
+    def insert(self, data):
+        if isinstance(data, list):
+            return self.insert_many(data)
+        return self.insert_one(data)
+
+    def insert_one(self, document):
+        return self.insert_many([document]).inserted_ids[0]
+
+    def insert_many(self, documents):
+        with self._lock:
+            ids = [self.add(copy(document)) for document in documents]
+        for document, _id in zip(documents, ids):
+            document['_id'] = _id
+        return InsertResult(ids)
+
+    def update(self, filters, update, upsert=False):
+        # the legacy update of a single document
+        with self._lock:
+            for document in self.find_documents(filters, []):
+                self.replace(apply_update(document, update))
+                return {'n': 1, 'updatedExisting': True}
+            if not upsert:
+                return {'n': 0, 'updatedExisting': False}
+            _id = self.add(new_document(filters, update))
+            return {'n': 1, 'updatedExisting': False, 'upserted': _id}
+
+    def update_one(self, filters, update, upsert=False):
+        return self.update(filters, update, upsert=upsert)
+
+    def bulk_write(self, requests, ordered=True):
+        matched = 0
+        upserted = {}
+        with self._lock:
+            for index, request in enumerate(requests):
+                response = self.update(request._filter, request._doc,
+                                       upsert=request._upsert)
+                if 'upserted' in response:
+                    upserted[index] = response['upserted']
+                else:
+                    matched += response['n']
+        return BulkWriteResult(matched, matched, len(upserted), upserted)
+
+    def delete_many(self, filters):
+        with self._lock:
+            ids = [document['_id']
+                   for document in self.find_documents(filters, [])]
+            self.remove(ids)
+        return DeleteResult(len(ids))
+
+    def aggregate(self, pipeline):
+        raise NotImplementedError(
+            'aggregation pipelines need the mongo backend, check '
+            'DBManager.can_aggregate() first')
+
+    def create_index(self, keys):
+        name = '_'.join(f'{field}_{direction}' for field, direction in keys)
+        self.indexes[name] = list(keys)
+        return name
+
+    def index_information(self):
+        return {name: {'key': keys} for name, keys in self.indexes.items()}
+
+
+class MemoryCollection(Collection):
+    def __init__(self, name):
+        super().__init__(name)
+        self.documents = {}
+        self.last_id = 0
+
+    def find_documents(self, filters, sort, limit=0):
+        with self._lock:
+            documents = [document for document in self.documents.values()
+                         if match(document, filters)]
+        for field, direction in reversed(sort):
+            documents.sort(key=sort_key(field), reverse=direction < 0)
+        return iter(documents)
+
+    def explain(self, filters, sort):
+        return {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}
+
+    def add(self, document):
+        self.last_id += 1
+        document['_id'] = self.last_id
+        self.documents[self.last_id] = document
+        return self.last_id
+
+    def replace(self, document):
+        self.documents[document['_id']] = document
+
+    def remove(self, ids):
+        for _id in ids:
+            del self.documents[_id]
+
+    def drop(self):
+        with self._lock:
+            self.documents.clear()
+            self.indexes.clear()
+
+
+class SqliteCollection(Collection):
+    # the documents are pickled, their scalar fields are also kept as json
+    # for the filters, sorts and the expression indexes
+    def __init__(self, name, connection, lock):
+        super().__init__(name)
+        self.connection = connection
+        self._lock = lock
+        self.table = '"%s"' % name.replace('"', '""')
+        self._create()
+
+    def _create(self):
+        with self._lock, self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                f'id INTEGER PRIMARY KEY AUTOINCREMENT, doc BLOB, keys TEXT)')
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, datetime):
+            return value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        raise TypeError(value)
+
+    @classmethod
+    def get_keys(cls, document):
+        keys = {}
+        for field, value in document.items():
+            try:
+                keys[field] = cls.encode(value)
+            except TypeError:
+                pass
+        return json.dumps(keys)
+
+    @staticmethod
+    def get_column(field):
+        field = field.replace('"', '""').replace("'", "''")
+        return f"json_extract(keys, '$.\"{field}\"')"
+
+    def get_where(self, filters):
+        # the conditions sqlite can check, the documents are matched again
+        # after decoding
+        clauses = []
+        args = []
+        exact = True
+        for field, condition in filters.items():
+            column = self.get_column(field)
+            conditions = condition.items() if is_operator(condition) else \
+                [('$eq', condition)]
+            for operator, arg in conditions:
+                try:
+                    if operator == '$in':
+                        values = [self.encode(value) for value in arg
+                                  if value is not None]
+                        clause = f'{column} IN (%s)' % ', '.join(
+                            '?' * len(values))
+                        if None in arg:
+                            clause = f'({clause} OR {column} IS NULL)'
+                        clauses.append(clause)
+                        args.extend(values)
+                    elif arg is None:
+                        if operator == '$eq':
+                            clauses.append(f'{column} IS NULL')
+                    else:
+                        sign = {'$eq': '=', '$gt': '>', '$gte': '>=',
+                                '$lt': '<', '$lte': '<='}[operator]
+                        clauses.append(f'{column} {sign} ?')
+                        args.append(self.encode(arg))
+                except (KeyError, TypeError):
+                    exact = False
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, args, exact
+
+    def get_query(self, filters, sort, limit=0):
+        where, args, exact = self.get_where(filters)
+        order = ''
+        if sort:
+            order = ' ORDER BY ' + ', '.join(
+                self.get_column(field) + (' DESC' if direction < 0 else '')
+                for field, direction in sort)
+        query = f'SELECT id, doc FROM {self.table}{where}{order}'
+        if limit and exact:
+            query += f' LIMIT {int(limit)}'
+        return query, args
+
+    def find_documents(self, filters, sort, limit=0):
+        query, args = self.get_query(filters, sort, limit)
+        with self._lock:
+            rows = self.connection.execute(query, args).fetchall()
+        for _id, data in rows:
+            document = pickle.loads(data)
+            document['_id'] = _id
+            if match(document, filters):
+                yield document
+
+    def explain(self, filters, sort):
+        query, args = self.get_query(filters, sort)
+        with self._lock:
+            plan = self.connection.execute('EXPLAIN QUERY PLAN ' + query,
+                                           args).fetchall()
+        details = ' '.join(row[-1] for row in plan)
+        stage = 'IXSCAN' if 'USING INDEX' in details else 'COLLSCAN'
+        return {'queryPlanner': {'winningPlan': {'stage': stage,
+                                                 'details': details}}}
+
+    def add(self, document):
+        document.pop('_id', None)
+        with self.connection:
+            cursor = self.connection.execute(
+                f'INSERT INTO {self.table} (doc, keys) VALUES (?, ?)',
+                (pickle.dumps(document), self.get_keys(document)))
+        return cursor.lastrowid
+
+    def replace(self, document):
+        document = dict(document)
+        _id = document.pop('_id')
+        with self.connection:
+            self.connection.execute(
+                f'UPDATE {self.table} SET doc = ?, keys = ? WHERE id = ?',
+                (pickle.dumps(document), self.get_keys(document), _id))
+
+    def remove(self, ids):
+        with self.connection:
+            self.connection.executemany(
+                f'DELETE FROM {self.table} WHERE id = ?',
+                [(_id, ) for _id in ids])
+
+    def create_index(self, keys):
+        name = super().create_index(keys)
+        columns = ', '.join(
+            self.get_column(field) + (' DESC' if direction < 0 else '')
+            for field, direction in keys)
+        index = '"%s_%s"' % (self.name.replace('"', '""'), name)
+        with self._lock, self.connection:
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS {index} ON {self.table} '
+                f'({columns})')
+        return name
+
+    def drop(self):
+        with self._lock, self.connection:
+            self.connection.execute(f'DROP TABLE IF EXISTS {self.table}')
+            self.indexes.clear()
+        self._create()
+
+
+class EmbeddedClient:
+    # client.market[collection] just like the pymongo client
+    def __init__(self):
+        self.collections = {}
+        self._lock = threading.Lock()
+
+    @property
+    def market(self):
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self.collections:
+                self.collections[name] = self.create(name)
+            return self.collections[name]
+
+
+class MemoryClient(EmbeddedClient):
+    def create(self, name):
+        return MemoryCollection(name)
+
+
+class SqliteClient(EmbeddedClient):
+    def __init__(self, path):
+        super().__init__()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.db_lock = threading.RLock()
+
+    def create(self, name):
+        return SqliteCollection(name, self.connection, self.db_lock)
@@ -1,15 +1,47 @@
 from flask import Flask
+from tabulate import tabulate
 
+from portfolio.config import REFRESHER
 
-def create_app():
+
+def create_app(refresher=REFRESHER):
     app = Flask(__name__)
     app.config.update(
         SECRET_KEY='123456'
     )
 
-    from portfolio.web.routes import tables, forms, pages, charts
+    from portfolio.web.routes import tables, forms, pages, charts, api
     app.register_blueprint(tables.tables)
     app.register_blueprint(forms.forms)
     app.register_blueprint(pages.pages)
     app.register_blueprint(charts.charts)
+    app.register_blueprint(api.api)
+
+    from portfolio.managers import (
+        SecuritiesManager, audit_indexes, ensure_indexes)
+    ensure_indexes()
+
+    from portfolio.refresher import QuoteRefresher, start_refresher
+    if refresher:
+        app.extensions['refresher'] = start_refresher()
+
+    @app.cli.command('refresh-quotes')
+    def refresh_quotes():
+        """Keep the live prices and today's candles updated."""
+        QuoteRefresher().run()
+
+    @app.cli.command('refresh-securities')
+    def refresh_securities():
+        """Reload the catalog of instruments."""
+        indexes = SecuritiesManager.refresh()
+        print(f'{len(indexes["figi"])} instruments')
+
+    @app.cli.command('audit-indexes')
+    def audit_indexes_command():
+        """Explain the queries of the managers, flag collection scans."""
+        data = [[collection, ', '.join(query), ' <- '.join(stages),
+                 'SCAN' if 'COLLSCAN' in stages else '']
+                for collection, query, stages in audit_indexes()]
+        print(tabulate(data, headers=['Collection', 'Query', 'Plan', '']))
+
     return app
@@ -0,0 +1,140 @@
+from datetime import datetime
+
+from flask import Blueprint, jsonify, request
+
+from portfolio.managers import (
+    CommissionManager, DividendManager, MoneyManager, OrdersManager,
+    SnapshotManager)
+from portfolio.portfolio import Portfolio
+
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+LEDGER_MANAGERS = {
+    manager.collection: manager
+    for manager in (OrdersManager, MoneyManager, DividendManager,
+                    CommissionManager)
+}
+
+# fields with a default, the others are required
+DEFAULTS = {
+    'comment': '',
+}
+
+
+def to_date(value):
+    value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        raise ValueError('local time expected')
+    return value
+
+
+def to_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('number expected')
+    return float(value)
+
+
+def to_integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('integer expected')
+    return value
+
+
+def to_text(value):
+    if not isinstance(value, str):
+        raise ValueError('string expected')
+    return value.strip()
+
+
+def to_choice(*choices):
+    def convert(value):
+        if value not in choices:
+            raise ValueError(f'one of {", ".join(choices)} expected')
+        return value
+    return convert
+
+
+FIELDS = {
+    'date': to_date,
+    'cur': to_choice(Portfolio.RUB, Portfolio.USD, Portfolio.EUR),
+    'sum': to_number,
+    'price': to_number,
+    'quantity': to_integer,
+    'portfolio': to_integer,
+    'broker': to_integer,
+    'isin': to_text,
+    'market': to_choice(Portfolio.MB, Portfolio.SPB),
+    'comment': to_text,
+}
+
+
+def validate(manager, entry):
+    if not isinstance(entry, dict):
+        raise ValueError('object expected')
+    unknown = set(entry) - set(manager.model._fields)
+    if unknown:
+        raise ValueError(f'unknown fields {", ".join(sorted(unknown))}')
+
+    data = {}
+    for field in manager.model._fields:
+        if field not in entry:
+            if field not in DEFAULTS:
+                raise ValueError(f'{field} is required')
+            data[field] = DEFAULTS[field]
+            continue
+        try:
+            data[field] = FIELDS[field](entry[field])
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'{field}: {e}') from None
+
+    # the ledger keeps the direction of orders in the quantity and of the
+    # commission in the collection
+    if manager in (OrdersManager, CommissionManager) and data['sum'] <= 0:
+        raise ValueError('sum must be positive')
+    if manager is OrdersManager and not data['quantity']:
+        raise ValueError('quantity must not be zero')
+    return manager.model(**data)
+
+
+@api.route('/ledger', methods=('POST', ))
+def ledger_submit():
+    # {collection: [entry, ...]} for orders, money, dividends and commission,
+    # nothing is written unless every entry is valid
+    batch = request.get_json(silent=True)
+    if not isinstance(batch, dict):
+        return jsonify(errors=[{'error': 'JSON object expected'}]), 400
+
+    entries = {}
+    errors = []
+    for collection, items in batch.items():
+        manager = LEDGER_MANAGERS.get(collection)
+        if manager is None:
+            errors.append({'collection': collection,
+                           'error': 'unknown collection'})
+            continue
+        if not isinstance(items, list):
+            errors.append({'collection': collection,
+                           'error': 'list expected'})
+            continue
+        entries[manager] = []
+        for index, entry in enumerate(items):
+            try:
+                entries[manager].append(validate(manager, entry)._asdict())
+            except ValueError as e:
+                errors.append({'collection': collection, 'index': index,
+                               'error': str(e)})
+    if errors:
+        return jsonify(errors=errors), 400
+
+    # one bulk write per collection, the entries already stored are matched
+    # so a batch can be resent, the snapshots are invalidated once
+    result = {}
+    with SnapshotManager.deferred():
+        for manager, data in entries.items():
+            response = manager.bulk_upsert(data, data)
+            result[manager.collection] = {
+                'received': len(data),
+                'inserted': response.upserted_count if response else 0,
+            }
+    return jsonify(result)
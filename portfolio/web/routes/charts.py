@@ -75,6 +75,36 @@ def value_chart():
     return templating.render_template('chart.html', data=data)
 
 
+@charts.route('/intraday')
+def intraday_chart():
+    cur = request.args.get('cur', Portfolio.RUB)
+    broker = request.args.get('broker')
+    interval = request.args.get('interval', 'hour')
+    date = request.args.get('date')
+    date = datetime.strptime(date, '%Y-%m-%d') if date else datetime.now()
+
+    portfolio = Portfolio(1, broker_id=int(broker) if broker else None)
+    times, values = portfolio.get_intraday_history(date, currency=cur,
+                                                   interval=interval)
+
+    data = {
+        'data': [{
+            'x': times,
+            'y': values,
+            'name': 'value',
+        }],
+        'layout': {
+            'autosize': False,
+            'width': 1900,
+            'height': 900,
+            'title': date.strftime('%Y-%m-%d'),
+        }
+    }
+
+    data = json.dumps(data, cls=plotly.utils.PlotlyJSONEncoder)
+    return templating.render_template('chart.html', data=data)
+
+
 @charts.route('/profit')
 def profit_chart():
     start_date = None
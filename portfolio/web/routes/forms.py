@@ -1,18 +1,28 @@
 import datetime
+import os
+import tempfile
+import time
 
-from flask import Blueprint, templating, redirect, request
+from flask import Blueprint, abort, jsonify, templating, redirect, request
 from flask_wtf import FlaskForm, file
 from wtforms import (
     StringField, FloatField, IntegerField, SelectField, HiddenField)
 from wtforms.validators import DataRequired
-from wtforms.fields.html5 import DateField
+try:
+    from wtforms.fields.html5 import DateField
+except ImportError:
+    # moved to wtforms.fields by WTForms 3
+    from wtforms.fields import DateField
 
 
+from portfolio.config import (
+    JOB_TIMEOUT, REPORT_PREVIEW_SIZE, REPORT_UPLOAD_DIR)
+from portfolio.jobs import job_queue
 from portfolio.portfolio import Portfolio
 from portfolio.managers import (
     Order, Money, Dividend, Commission,
-    OrdersManager, MoneyManager, DividendManager)
-from portfolio.parsers import parse
+    OrdersManager, MoneyManager, DividendManager, JobsManager)
+from portfolio.parsers import parse_file
 from portfolio.web.routes.tables import (
     OrdersTable, MoneyTable, DividendsTable, CommissionTable)
 
@@ -106,24 +116,91 @@ class ReportForm(FlaskForm):
     test = HiddenField('test')
 
 
+REPORT_MODELS = (Order, Money, Dividend, Commission)
+
+
+def load_report_job(path, broker, test, progress):
+    # the number and the first REPORT_PREVIEW_SIZE new items by model name
+    result = {model.__name__: {'count': 0, 'items': []}
+              for model in REPORT_MODELS}
+
+    def collect(items):
+        for item in items:
+            data = result[type(item).__name__]
+            data['count'] += 1
+            if len(data['items']) < REPORT_PREVIEW_SIZE:
+                data['items'].append(item._asdict())
+
+    try:
+        parse_file(path, broker, test=test, progress=progress,
+                   collect=collect)
+    finally:
+        os.remove(path)
+    return result
+
+
+def save_report(report):
+    # the files left by the jobs lost with their process are removed once
+    # the jobs time out
+    os.makedirs(REPORT_UPLOAD_DIR, exist_ok=True)
+    limit = time.time() - JOB_TIMEOUT.total_seconds()
+    for entry in os.scandir(REPORT_UPLOAD_DIR):
+        try:
+            if entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    fd, path = tempfile.mkstemp(suffix='.xml', dir=REPORT_UPLOAD_DIR)
+    os.close(fd)
+    try:
+        report.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
 @forms.route('/report', methods=('GET', 'POST'))
 def load_report():
     form = ReportForm()
     if form.validate_on_submit():
-        content = request.files['report'].read()
+        # parsed in the background, the page polls the job status
+        path = save_report(request.files['report'])
         broker = form.data['broker']
         test = bool(form.data['test'])
-        items = parse(content, broker, test=test)
-        orders = [item for item in items if isinstance(item, Order)]
-        money = [item for item in items if isinstance(item, Money)]
-        dividend = [item for item in items if isinstance(item, Dividend)]
-        commission = [item for item in items if isinstance(item, Commission)]
-
-        tables = [
-            OrdersTable(orders, classes=['table', 'table-dark']),
-            MoneyTable(money, classes=['table', 'table-dark']),
-            DividendsTable(dividend, classes=['table', 'table-dark']),
-            CommissionTable(commission, classes=['table', 'table-dark'])
-        ]
-        return templating.render_template('tables.html', tables=tables)
+        try:
+            job = job_queue.submit('report', load_report_job, path, broker,
+                                   test)
+        except Exception:
+            os.remove(path)
+            raise
+        return redirect(f'/forms/report/{job}')
     return templating.render_template('form.html', form=form)
+
+
+@forms.route('/report/<job>')
+def report_job(job):
+    job = JobsManager.find(job)
+    if job is None:
+        abort(404)
+    if job.status != JobsManager.DONE:
+        return templating.render_template('job.html', job=job)
+
+    tables = []
+    for model, table in zip(REPORT_MODELS, (
+            OrdersTable, MoneyTable, DividendsTable, CommissionTable)):
+        data = job.result[model.__name__]
+        table = table([model(**item) for item in data['items']],
+                      classes=['table', 'table-dark'])
+        table.count = data['count']
+        tables.append(table)
+    return templating.render_template('tables.html', tables=tables)
+
+
+@forms.route('/report/<job>/status')
+def report_job_status(job):
+    job = JobsManager.find(job)
+    if job is None:
+        abort(404)
+    return jsonify(status=job.status, progress=job.progress, error=job.error)
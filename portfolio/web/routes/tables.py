@@ -1,4 +1,11 @@
+import flask
 from flask import Blueprint, templating, request
+from markupsafe import Markup
+
+# flask_table imports Markup from flask, which Flask 3 no longer exports
+if not hasattr(flask, 'Markup'):
+    flask.Markup = Markup
+
 from flask_table import Table, Col
 
 from portfolio.managers import MoneyManager, OrdersManager, DividendManager
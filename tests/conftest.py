@@ -0,0 +1,118 @@
+import math
+from datetime import datetime, timedelta
+
+import pytest
+
+import portfolio.base as base
+from portfolio.loaders import QuotesLoader
+from portfolio.managers import (
+    CommissionManager, DividendManager, LedgerManager, MoneyManager,
+    OrdersManager, QuotesManager, SecuritiesManager)
+from portfolio.storage import MemoryClient
+
+
+SECURITIES = [
+    {'isin': 'AAA', 'figi': 'FAAA', 'ticker': 'AAA', 'type': 'Stock',
+     'currency': 'RUB'},
+    {'isin': 'BBB', 'figi': 'FBBB', 'ticker': 'BBB', 'type': 'Stock',
+     'currency': 'USD'},
+    {'isin': 'CCC', 'figi': 'FCCC', 'ticker': 'CCC', 'type': 'Stock',
+     'currency': 'EUR'},
+    {'isin': 'BOND', 'figi': 'FBOND', 'ticker': 'BND', 'type': 'Bond',
+     'currency': 'RUB', 'faceValue': 1000},
+    {'isin': 'BAG', 'figi': 'FUSD', 'ticker': 'USD000UTSTOM',
+     'type': 'Currency', 'currency': 'RUB'},
+    {'isin': 'BAG2', 'figi': 'FEUR', 'ticker': 'EUR_RUB__TOM',
+     'type': 'Currency', 'currency': 'RUB'},
+]
+
+
+def get_price(isin, day):
+    seed = sum(ord(c) for c in isin)
+    return round(50 + seed % 37 + 10 * math.sin(day.toordinal() / 7 + seed),
+                 4)
+
+
+def get_history(isin, time_range, interval=QuotesLoader.DAY):
+    # the daily candles of the working days up to yesterday
+    data = []
+    day = time_range.start_time
+    while day <= time_range.end_time and day.date() < datetime.now().date():
+        if day.weekday() < 5:
+            data.append({'time': day + timedelta(hours=7),
+                         'price': get_price(isin, day), 'isin': isin.upper(),
+                         'figi': 'F' + isin.upper(), 'interval': interval})
+        day += timedelta(days=1)
+    return data
+
+
+def get_date(month, day):
+    return datetime(2023, month, day, 12)
+
+
+def ledger_entry(**data):
+    return dict(data, portfolio=1, broker=1)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    client = MemoryClient()
+    monkeypatch.setattr(base, '_CLIENT', client)
+    monkeypatch.setattr(base, '_GENERATIONS_READ', None)
+    monkeypatch.setattr(SecuritiesManager, '_indexes', None)
+    monkeypatch.setattr(SecuritiesManager, '_lookups', {})
+    QuotesManager.cache.clear()
+    LedgerManager.get_data.cache_clear()
+    LedgerManager.get_daily_sums.cache_clear()
+    monkeypatch.setattr(QuotesLoader, 'history', get_history)
+
+    now = datetime.now()
+    client.market['securities'].insert_many(
+        [dict(security, updated=now) for security in SECURITIES])
+    return client
+
+
+@pytest.fixture
+def app(db):
+    from portfolio.web.app import create_app
+    app = create_app(refresher=False)
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    return app
+
+
+@pytest.fixture
+def ledger(db):
+    MoneyManager.insert([
+        ledger_entry(date=get_date(1, 9), cur='RUB', sum=100000.0,
+                     comment=''),
+        ledger_entry(date=get_date(1, 16), cur='USD', sum=1000.0,
+                     comment=''),
+        ledger_entry(date=get_date(3, 4), cur='RUB', sum=5000.0,
+                     comment=''),
+    ])
+    OrdersManager.insert([
+        ledger_entry(date=get_date(1, 10), isin='AAA', quantity=100,
+                     price=60.0, sum=6000.0, cur='RUB', market='MB'),
+        ledger_entry(date=get_date(1, 17), isin='BBB', quantity=5,
+                     price=60.0, sum=300.0, cur='USD', market='SPB'),
+        ledger_entry(date=get_date(2, 5), isin='USD', quantity=100,
+                     price=70.0, sum=7000.0, cur='RUB', market='MB'),
+        ledger_entry(date=get_date(3, 1), isin='AAA', quantity=-40,
+                     price=61.0, sum=2440.0, cur='RUB', market='MB'),
+        ledger_entry(date=get_date(3, 8), isin='CCC', quantity=2,
+                     price=55.0, sum=110.0, cur='EUR', market='SPB'),
+        ledger_entry(date=get_date(3, 8), isin='EUR', quantity=200,
+                     price=80.0, sum=16000.0, cur='RUB', market='MB'),
+        ledger_entry(date=get_date(4, 3), isin='BBB', quantity=-5,
+                     price=61.0, sum=305.0, cur='USD', market='SPB'),
+    ])
+    DividendManager.insert([
+        ledger_entry(date=get_date(2, 20), cur='RUB', sum=123.0,
+                     comment='div'),
+    ])
+    CommissionManager.insert([
+        ledger_entry(date=get_date(1, 10), cur='RUB', sum=15.0,
+                     comment='c'),
+        ledger_entry(date=get_date(3, 8), cur='RUB', sum=3.5, comment='c'),
+    ])
+    return db
@@ -0,0 +1,83 @@
+from datetime import datetime
+
+import pytest
+
+from portfolio.managers import MoneyManager, OrdersManager, SnapshotManager
+
+
+ORDER = {'date': '2023-03-20T12:00:00', 'cur': 'RUB', 'sum': 620.0,
+         'price': 62.0, 'quantity': 10, 'portfolio': 1, 'broker': 1,
+         'isin': ' AAA ', 'market': 'MB'}
+MONEY = {'date': '2023-03-21T12:00:00', 'cur': 'USD', 'sum': -100,
+         'portfolio': 1, 'broker': 1}
+
+
+def post(app, batch):
+    response = app.test_client().post('/api/ledger', json=batch)
+    return response.status_code, response.get_json()
+
+
+def test_ledger(app, ledger):
+    SnapshotManager.save(SnapshotManager.VALUE, 'RUB', 1, None, [
+        ((2023, 3, 1), 1.0, {}), ((2023, 3, 25), 1.0, {})])
+    batch = {'orders': [ORDER], 'money': [MONEY], 'dividends': []}
+    assert post(app, batch) == (200, {
+        'orders': {'received': 1, 'inserted': 1},
+        'money': {'received': 1, 'inserted': 1},
+        'dividends': {'received': 0, 'inserted': 0}})
+
+    order = OrdersManager.get_first(date=datetime(2023, 3, 20, 12))
+    assert order['isin'] == 'AAA' and order['sum'] == 620.0
+    assert [row['date'] for row in SnapshotManager.get()] == [
+        datetime(2023, 3, 1)]
+
+    # a resent batch is matched to the stored entries
+    assert post(app, batch) == (200, {
+        'orders': {'received': 1, 'inserted': 0},
+        'money': {'received': 1, 'inserted': 0},
+        'dividends': {'received': 0, 'inserted': 0}})
+    assert len(list(OrdersManager.get())) == 8
+
+
+@pytest.mark.parametrize('batch, errors', [
+    ([ORDER], [{'error': 'JSON object expected'}]),
+    ({'trades': [ORDER]}, [{'collection': 'trades',
+                            'error': 'unknown collection'}]),
+    ({'orders': ORDER}, [{'collection': 'orders', 'error': 'list expected'}]),
+    ({'orders': [1]}, [{'collection': 'orders', 'index': 0,
+                        'error': 'object expected'}]),
+    ({'orders': [dict(ORDER, fee=1)]}, [{'collection': 'orders', 'index': 0,
+                                         'error': 'unknown fields fee'}]),
+    ({'money': [{'date': MONEY['date'], 'cur': 'RUB', 'sum': 1,
+                 'portfolio': 1}]},
+     [{'collection': 'money', 'index': 0, 'error': 'broker is required'}]),
+    ({'orders': [dict(ORDER, date='2023-03-20T12:00:00+03:00')]},
+     [{'collection': 'orders', 'index': 0,
+       'error': 'date: local time expected'}]),
+    ({'orders': [dict(ORDER, cur='GBP')]},
+     [{'collection': 'orders', 'index': 0,
+       'error': 'cur: one of RUB, USD, EUR expected'}]),
+    ({'orders': [dict(ORDER, quantity=1.5)]},
+     [{'collection': 'orders', 'index': 0,
+       'error': 'quantity: integer expected'}]),
+    ({'money': [dict(MONEY, sum=True)]},
+     [{'collection': 'money', 'index': 0, 'error': 'sum: number expected'}]),
+    ({'orders': [dict(ORDER, sum=-620.0)]},
+     [{'collection': 'orders', 'index': 0, 'error': 'sum must be positive'}]),
+    ({'orders': [dict(ORDER, quantity=0)]},
+     [{'collection': 'orders', 'index': 0,
+       'error': 'quantity must not be zero'}]),
+])
+def test_ledger_invalid(app, db, batch, errors):
+    assert post(app, batch) == (400, {'errors': errors})
+    assert list(OrdersManager.get()) == []
+
+
+def test_ledger_nothing_written(app, db):
+    # one invalid entry rejects the whole batch
+    status, data = post(app, {'money': [MONEY], 'orders': [ORDER, {}]})
+    assert status == 400
+    assert [error['index'] for error in data['errors']] == [1]
+    assert list(MoneyManager.get()) == []
+    assert post(app, 'text') == (400, {
+        'errors': [{'error': 'JSON object expected'}]})
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pytest
+
+import portfolio.base as base
+from portfolio.base import TimeRange
+from portfolio.managers import MoneyManager, QuotesManager
+
+
+def test_quotes_not_shared(db):
+    time_range = TimeRange(datetime(2023, 1, 9), datetime(2023, 1, 20))
+    # the loading writes the quotes, they are cached once read again
+    QuotesManager.get_quotes('AAA', time_range)
+    quotes = QuotesManager.get_quotes('AAA', time_range)
+    expected = dict(quotes)
+    quotes[(2023, 1, 9)] = 0
+    quotes[(2023, 1, 21)] = 0
+
+    cached = QuotesManager.get_quotes('AAA', time_range)
+    assert dict(cached) == expected
+    with pytest.raises(TypeError):
+        cached[(2023, 1, 9)] = 0
+    assert dict(QuotesManager.get_quotes('AAA', time_range)) == expected
+    assert list(reversed(cached.values()))[0] == expected[(2023, 1, 20)]
+
+
+def test_quotes_written(db, monkeypatch):
+    time_range = TimeRange(datetime(2023, 1, 9), datetime(2023, 1, 20))
+    time = datetime(2023, 1, 10, 7)
+    QuotesManager.get_quotes('AAA', time_range)
+    QuotesManager.write('AAA', 'day', TimeRange(time, time), [{
+        'time': time, 'price': 1.0, 'isin': 'AAA', 'figi': 'FAAA',
+        'interval': 'day'}])
+    assert QuotesManager.get_quotes('AAA', time_range)[(2023, 1, 10)] == 1.0
+
+    # the candle of the current day doesn't drop the cached quotes
+    generation = QuotesManager.get_generation()
+    QuotesManager.append_today('AAA')
+    assert QuotesManager.get_generation() == generation
+
+    # the write of another process is seen once the generations expire
+    db.market['quotes'].update({'isin': 'AAA', 'time': time},
+                               {'$set': {'price': 2.0}})
+    db.market[base.GENERATIONS].update({'collection': 'quotes'},
+                                       {'$inc': {'generation': 1}})
+    assert QuotesManager.get_quotes('AAA', time_range)[(2023, 1, 10)] == 1.0
+    monkeypatch.setattr(base, 'GENERATIONS_TTL', 0)
+    assert QuotesManager.get_quotes('AAA', time_range)[(2023, 1, 10)] == 2.0
+
+
+def test_ledger_not_shared(ledger):
+    items = MoneyManager.get_data(1)
+    assert MoneyManager.get_data(1) is items
+    with pytest.raises(AttributeError):
+        items.append(items[0])
+    assert isinstance(MoneyManager.get_daily_sums(1), tuple)
+
+    columns = MoneyManager.get_data(1, columns=True)
+    with pytest.raises(ValueError):
+        columns['sum'][0] = 0
+    with pytest.raises(TypeError):
+        columns['sum'] = None
+    assert list(MoneyManager.get_data(1, columns=True)['sum']) == [
+        item.sum for item in items]
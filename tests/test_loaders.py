@@ -0,0 +1,125 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from portfolio.loaders import HttpClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.ports.add(self.client_address[1])
+            count = server.requests.count(self.path)
+
+        if self.path.startswith('/fail'):
+            # fails the first given number of requests
+            status = 503 if count <= int(self.path.split('/')[2]) else 200
+        elif self.path == '/missing':
+            status = 404
+        elif self.path == '/slow':
+            time.sleep(0.5)
+            status = 200
+        else:
+            status = 200
+        self.reply(status)
+
+    def reply(self, status):
+        body = str(status).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_client(server, **kwargs):
+    kwargs.setdefault('backoff', 0)
+    host, port = server.server_address
+    return HttpClient(f'http://{host}:{port}', **kwargs)
+
+
+def test_retry_on_server_error(server):
+    client = get_client(server, retries=3)
+    response = client.get('/fail/2')
+    assert response.text == '200'
+    assert server.requests == ['/fail/2'] * 3
+
+
+def test_retries_exhausted(server):
+    client = get_client(server, retries=2)
+    with pytest.raises(requests.HTTPError) as e:
+        client.get('/fail/5')
+    assert e.value.response.status_code == 503
+    assert server.requests == ['/fail/5'] * 3
+
+
+def test_no_retry_on_client_error(server):
+    client = get_client(server, retries=3)
+    with pytest.raises(requests.HTTPError):
+        client.get('/missing')
+    assert server.requests == ['/missing']
+
+
+def test_timeout(server):
+    client = get_client(server, retries=1, timeout=0.1)
+    with pytest.raises(requests.Timeout):
+        client.get('/slow')
+    assert server.requests == ['/slow'] * 2
+
+    response = client.get('/slow', timeout=2)
+    assert response.text == '200'
+
+
+def test_session_reuse(server):
+    client = get_client(server)
+    session = client.session
+    for _ in range(5):
+        client.get('/ok')
+    assert client.session is session
+    # keep-alive, all the requests are sent over one connection
+    assert len(server.ports) == 1
+
+
+def test_pool_shared_by_threads(server):
+    client = get_client(server, pool_size=2, concurrency=2)
+    sessions = []
+
+    def run():
+        sessions.append(client.session)
+        for _ in range(10):
+            client.get('/ok')
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(server.requests) == 40
+    assert len({id(session) for session in sessions}) == 4
+    # the sessions share the adapter so at most the concurrency limit of
+    # connections is opened
+    assert len(server.ports) <= 2
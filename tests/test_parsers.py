@@ -0,0 +1,85 @@
+from datetime import datetime
+
+import pytest
+
+from portfolio import parsers
+from portfolio.managers import CommissionManager, MoneyManager
+
+
+def get_transfer(day, amount, operation='Зачисление денежных средств'):
+    return (f'<Подробности16 operation_type="{operation}" notes1="" '
+            f'debt_type4="2023-01-{day:02}T00:00:00" debt_date4="{amount}" '
+            f'decree_amount2="RUR"/>')
+
+
+def get_report(*places):
+    places = ''.join(
+        f'<DDS_place><Подробности16_Collection>{"".join(records)}'
+        f'</Подробности16_Collection></DDS_place>' for records in places)
+    return (f'<?xml version="1.0" encoding="utf-8"?><Report xmlns="urn:vtb">'
+            f'<Tablix_b4><DDS_place_Collection>{places}'
+            f'</DDS_place_Collection></Tablix_b4></Report>').encode()
+
+
+def get_sums(items):
+    return [(type(item).__name__, item.date.day, item.sum) for item in items]
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    monkeypatch.setattr(parsers, 'PARSER_BATCH_SIZE', 2)
+
+
+def test_bulk_upsert(db, batch):
+    MoneyManager.insert({'date': datetime(2023, 1, 2), 'cur': 'RUB',
+                         'sum': 200.0, 'comment': '', 'portfolio': 1,
+                         'broker': 2})
+    report = get_report([
+        get_transfer(1, 100), get_transfer(2, 200), get_transfer(3, 300),
+        get_transfer(1, 100),
+        get_transfer(4, -4, 'Вознаграждение Брокера'), get_transfer(3, 300),
+    ])
+
+    # the stored and the repeated records are not new, the new items keep
+    # the report order across the collections and the batches
+    items = parsers.parse(report, parsers.Portfolio.VTB, test=False)
+    assert get_sums(items) == [('Money', 1, 100.0), ('Money', 3, 300.0),
+                               ('Commission', 4, 4.0)]
+    assert len(list(MoneyManager.get())) == 3
+    assert len(list(CommissionManager.get())) == 1
+
+    assert parsers.parse(report, parsers.Portfolio.VTB, test=False) == []
+
+
+def test_test_mode(db, batch):
+    MoneyManager.insert({'date': datetime(2023, 1, 2), 'cur': 'RUB',
+                         'sum': 200.0, 'comment': '', 'portfolio': 1,
+                         'broker': 2})
+    report = get_report([
+        get_transfer(1, 100), get_transfer(2, 200), get_transfer(3, 300),
+        get_transfer(1, 100), get_transfer(5, 500), get_transfer(3, 300),
+    ])
+
+    # nothing is written, the duplicates of the previous batches are still
+    # found
+    items = parsers.parse(report, parsers.Portfolio.VTB, test=True)
+    assert get_sums(items) == [('Money', 1, 100.0), ('Money', 3, 300.0),
+                               ('Money', 5, 500.0)]
+    assert len(list(MoneyManager.get())) == 1
+    assert get_sums(parsers.parse(report, parsers.Portfolio.VTB)) == \
+        get_sums(items)
+
+
+def test_first_place(db):
+    # the transfers of the other places are not read, like the baseline
+    report = get_report([get_transfer(1, 100)], [get_transfer(2, 200)])
+    items = parsers.parse(report, parsers.Portfolio.VTB, test=True)
+    assert get_sums(items) == [('Money', 1, 100.0)]
+
+
+def test_collect(db, batch):
+    report = get_report([get_transfer(day, day) for day in range(1, 6)])
+    batches = []
+    assert parsers.parse(report, parsers.Portfolio.VTB, test=False,
+                         collect=batches.append) == []
+    assert [len(items) for items in batches] == [2, 2, 1]
@@ -0,0 +1,116 @@
+from datetime import datetime
+
+import pytest
+
+from portfolio.base import TimeRange
+from portfolio.managers import OrdersManager, QuotesManager, SnapshotManager
+from portfolio.portfolio import Portfolio
+
+
+RANGES = [
+    TimeRange(None, datetime(2023, 5, 31)),
+    TimeRange(datetime(2023, 2, 1), datetime(2023, 3, 15)),
+    TimeRange(datetime(2023, 3, 8), datetime(2023, 3, 8)),
+]
+
+
+def get_history(time_range, currency, engine, broker_id=None):
+    SnapshotManager.clear()
+    history = Portfolio(1, broker_id).get_value_history(
+        time_range, currency=currency, engine=engine)
+    return list(history.keys()), list(history.values())
+
+
+@pytest.mark.parametrize('time_range', RANGES)
+@pytest.mark.parametrize('currency', Portfolio.CURRENCIES)
+def test_engines(ledger, time_range, currency):
+    dates, values = get_history(time_range, currency, Portfolio.PYTHON)
+    numpy_dates, numpy_values = get_history(time_range, currency,
+                                            Portfolio.NUMPY)
+    assert dates and numpy_dates == dates
+    assert numpy_values == pytest.approx(values, rel=1e-12)
+
+
+def test_engines_broker(ledger):
+    time_range = RANGES[0]
+    assert get_history(time_range, Portfolio.RUB, Portfolio.NUMPY, 1) == \
+        get_history(time_range, Portfolio.RUB, Portfolio.PYTHON, 1)
+
+
+def test_unknown_engine(ledger):
+    with pytest.raises(ValueError):
+        Portfolio(1).get_value_history(RANGES[0], engine='fortran')
+
+
+def get_values(time_range, currency=Portfolio.RUB):
+    history = Portfolio(1).get_value_history(time_range, currency=currency)
+    return list(zip(history.keys(), history.values()))
+
+
+def get_snapshots(portfolio_id=1):
+    return [row['date'] for row in SnapshotManager.get(
+        portfolio=portfolio_id, sort='date')]
+
+
+def test_snapshots_resume(ledger):
+    time_range = RANGES[0]
+    SnapshotManager.clear()
+    cold = get_values(time_range)
+    assert get_snapshots()[-1] == datetime(2023, 5, 31)
+    assert get_values(time_range) == cold
+    assert get_values(RANGES[1]) == [
+        (date, value) for date, value in cold
+        if RANGES[1].start_time <= date <= RANGES[1].end_time]
+
+    OrdersManager.insert({
+        'date': datetime(2023, 3, 20, 12), 'isin': 'AAA', 'quantity': 10,
+        'price': 62.0, 'sum': 620.0, 'cur': 'RUB', 'market': 'MB',
+        'portfolio': 1, 'broker': 1})
+    assert get_snapshots()[-1] < datetime(2023, 3, 20)
+    warm = get_values(time_range)
+    SnapshotManager.clear()
+    assert warm == get_values(time_range)
+    before = datetime(2023, 3, 20)
+    assert [item for item in warm if item[0] < before] == \
+        [item for item in cold if item[0] < before]
+    assert warm != cold
+
+
+def test_cbr_resume(ledger):
+    time_range = RANGES[0]
+    SnapshotManager.clear()
+    cold = Portfolio(1).get_cbr_history(time_range)
+    warm = Portfolio(1).get_cbr_history(time_range)
+    assert list(zip(warm.keys(), warm.values())) == \
+        list(zip(cold.keys(), cold.values()))
+
+    # the ranged history accrues from the range start
+    ranged = Portfolio(1).get_cbr_history(RANGES[1])
+    SnapshotManager.clear()
+    ranged_cold = Portfolio(1).get_cbr_history(RANGES[1])
+    assert list(zip(ranged.keys(), ranged.values())) == \
+        list(zip(ranged_cold.keys(), ranged_cold.values()))
+    assert list(ranged.keys()) == [
+        date for date in cold.keys()
+        if RANGES[1].start_time <= date <= RANGES[1].end_time]
+
+
+def test_quotes_invalidate_holders(ledger):
+    SnapshotManager.clear()
+    get_values(RANGES[0])
+    SnapshotManager.save(SnapshotManager.VALUE, Portfolio.RUB, 2, None, [
+        ((2023, 3, 1), 1.0, {'portfolio': {}, 'prices': {}})])
+
+    QuotesManager.write('AAA', 'day', TimeRange(
+        datetime(2023, 3, 10), datetime(2023, 3, 10)), [{
+            'time': datetime(2023, 3, 10, 7), 'price': 1.0, 'isin': 'AAA',
+            'figi': 'FAAA', 'interval': 'day'}])
+    assert get_snapshots()[-1] == datetime(2023, 3, 9)
+    assert get_snapshots(2) == [datetime(2023, 3, 1)]
+
+    QuotesManager.write('USD', 'day', TimeRange(
+        datetime(2023, 2, 10), datetime(2023, 2, 10)), [{
+            'time': datetime(2023, 2, 10, 7), 'price': 1.0, 'isin': 'USD',
+            'figi': 'FUSD', 'interval': 'day'}])
+    assert get_snapshots()[-1] == datetime(2023, 2, 9)
+    assert get_snapshots(2) == []
@@ -0,0 +1,161 @@
+from collections import namedtuple
+from datetime import datetime
+
+import pytest
+
+import portfolio.base as base
+from portfolio.base import DBManager, TimeRange
+from portfolio.storage import MemoryClient, SqliteClient
+
+
+Item = namedtuple('Item', ['name', 'date', 'value', 'tags'])
+
+
+class ItemsManager(DBManager):
+    collection = 'items'
+    model = Item
+
+    indexes = (('name', 'date'), )
+    generations = True
+
+
+ITEMS = [
+    {'name': 'b', 'date': datetime(2023, 1, 2), 'value': 2.5, 'tags': ['x']},
+    {'name': 'a', 'date': datetime(2023, 1, 3), 'value': 1, 'tags': []},
+    {'name': 'c', 'date': datetime(2023, 1, 1), 'value': None,
+     'tags': ['x', 'y']},
+    {'name': 'a', 'date': datetime(2023, 1, 1), 'value': -4, 'tags': ['y']},
+]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def client(request, monkeypatch):
+    if request.param == 'memory':
+        client = MemoryClient()
+    else:
+        client = SqliteClient(':memory:')
+    monkeypatch.setattr(base, '_CLIENT', client)
+    ItemsManager.ensure_indexes()
+    ItemsManager.insert([dict(item) for item in ITEMS])
+    return client
+
+
+def get(**kwargs):
+    kwargs.setdefault('fields', {'_id': 0})
+    return list(ItemsManager.get(**kwargs))
+
+
+def test_get(client):
+    assert get(name='a', sort='date') == [ITEMS[3], ITEMS[1]]
+    assert get(date=TimeRange(datetime(2023, 1, 2), None),
+               sort='date') == [ITEMS[0], ITEMS[1]]
+    assert get(name={'$in': ['b', 'c']}, value={'$gt': 0}) == [ITEMS[0]]
+    assert get(value=None) == [ITEMS[2]]
+    assert get(name='d') == []
+
+
+def test_get_fields(client):
+    assert get(name='b', fields={'name': 1, 'value': 1, '_id': 0}) == [
+        {'name': 'b', 'value': 2.5}]
+    assert get(name='b', fields={'tags': 0, 'date': 0, '_id': 0}) == [
+        {'name': 'b', 'value': 2.5}]
+    first = ItemsManager.get_first(name='c')
+    assert first['tags'] == ['x', 'y'] and '_id' in first
+
+
+def test_sort(client):
+    assert [row['value'] for row in get(sort='value')] == [None, -4, 1, 2.5]
+    assert [row['value'] for row in get(sort=('value', -1))] == [
+        2.5, 1, -4, None]
+    assert [(row['name'], row['date'].day) for row in
+            get(sort=['name', ('date', -1)])] == [
+        ('a', 3), ('a', 1), ('b', 2), ('c', 1)]
+    assert [row['name'] for row in
+            ItemsManager.get(sort=('date', -1)).limit(2)] == ['a', 'b']
+
+
+def test_insert(client):
+    ItemsManager.insert({'name': 'd', 'date': datetime(2023, 1, 4),
+                         'value': 0, 'tags': []})
+    assert [row['name'] for row in get(sort='date')][-1] == 'd'
+    with pytest.raises(ValueError):
+        ItemsManager.insert({'unknown': 1})
+    assert ItemsManager.distinct('name') == ['b', 'a', 'c', 'd']
+
+
+def test_update(client):
+    ItemsManager.upsert({'name': 'b'}, {'value': 3})
+    ItemsManager.upsert({'name': 'e'}, {'name': 'e', 'value': 5})
+    assert get(name='b')[0]['value'] == 3
+    assert get(name='e') == [{'name': 'e', 'value': 5}]
+
+    response = ItemsManager.bulk_upsert(
+        [{'name': 'c'}, {'name': 'f'}],
+        [{'value': 6}, {'name': 'f', 'value': 7}])
+    assert response.upserted_count == 1
+    assert [row['value'] for row in get(name={'$in': ['c', 'f']},
+                                        sort='name')] == [6, 7]
+
+    assert ItemsManager.append({'name': 'b'}, {'tags': ['z']}) == 1
+    assert get(name='b')[0]['tags'] == ['x', 'z']
+
+
+def test_delete(client):
+    assert ItemsManager.delete(name='a').deleted_count == 2
+    assert ItemsManager.delete(
+        date=TimeRange(None, datetime(2023, 1, 1))).deleted_count == 1
+    assert get() == [ITEMS[0]]
+    ItemsManager.clear()
+    assert get() == []
+
+
+def test_aggregate(client):
+    assert not ItemsManager.can_aggregate()
+    with pytest.raises(NotImplementedError, match='mongo'):
+        ItemsManager.aggregate([{'$match': {'name': 'a'}}])
+
+
+def test_generations(client, monkeypatch):
+    generation = ItemsManager.get_generation()
+    ItemsManager.upsert({'name': 'b'}, {'value': 3})
+    assert ItemsManager.get_generation() == generation + 1
+
+    # a write of another process is seen once the generations expire
+    client.market[base.GENERATIONS].update(
+        {'collection': ItemsManager.collection},
+        {'$inc': {'generation': 1}})
+    assert ItemsManager.get_generation() == generation + 1
+    monkeypatch.setattr(base, 'GENERATIONS_TTL', 0)
+    assert ItemsManager.get_generation() == generation + 2
+
+
+def test_generations_off(client, monkeypatch):
+    # the managers without cached reads don't write the generations
+    monkeypatch.setattr(ItemsManager, 'generations', False)
+    monkeypatch.setattr(base, 'GENERATIONS_TTL', 0)
+    generation = ItemsManager.get_generation()
+    ItemsManager.upsert({'name': 'b'}, {'value': 3})
+    ItemsManager.delete(name='a')
+    assert ItemsManager.get_generation() == generation
+
+
+def test_range_none(client):
+    assert get(value={'$gte': None}) == []
+    assert get(date={'$lt': None}, name='a') == []
+    assert get(value={'$gt': 'x'}) == []
+    assert [row['value'] for row in get(value={'$gte': 1}, sort='value')] == \
+        [1, 2.5]
+
+
+def test_documents_not_shared(client):
+    ItemsManager.insert({'name': 'd', 'date': datetime(2023, 1, 4),
+                         'value': {'nested': [1]}, 'tags': []})
+    row = ItemsManager.get_first(name='d')
+    row['value']['nested'].append(2)
+    row['tags'].append('x')
+    assert ItemsManager.get_first(name='d')['value'] == {'nested': [1]}
+
+    data = {'value': {'nested': [3]}}
+    ItemsManager.upsert({'name': 'd'}, data)
+    data['value']['nested'].append(4)
+    assert ItemsManager.get_first(name='d')['value'] == {'nested': [3]}
@@ -0,0 +1,101 @@
+import io
+import os
+import re
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from portfolio.config import JOB_TIMEOUT
+from portfolio.managers import JobsManager, MoneyManager
+from portfolio.web.routes import forms
+from test_parsers import get_report, get_transfer
+
+
+@pytest.fixture
+def uploads(monkeypatch, tmp_path):
+    monkeypatch.setattr(forms, 'REPORT_UPLOAD_DIR', str(tmp_path))
+    return tmp_path
+
+
+def submit(client, report, test):
+    response = client.post('/forms/report', data={
+        'broker': forms.Portfolio.VTB, 'test': test,
+        'report': (io.BytesIO(report), 'report.xml')},
+        content_type='multipart/form-data')
+    assert response.status_code == 302
+    return response.headers['Location']
+
+
+def wait(client, url):
+    for _ in range(100):
+        status = client.get(f'{url}/status').get_json()
+        if status['status'] in (JobsManager.DONE, JobsManager.FAILED):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f'{url} not finished')
+
+
+def get_counts(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return dict(re.findall(r'(\w+)\((\d+)\)',
+                           response.get_data(as_text=True)))
+
+
+def test_report_job(app, uploads):
+    client = app.test_client()
+    report = get_report([get_transfer(1, 100), get_transfer(2, 200),
+                         get_transfer(3, -3, 'Вознаграждение Брокера')])
+
+    url = submit(client, report, '1')
+    assert wait(client, url) == {'status': JobsManager.DONE, 'progress': 1,
+                                 'error': None}
+    assert get_counts(client, url) == {'Orders': '0', 'Money': '2',
+                                       'Dividends': '0', 'Commission': '1'}
+    assert list(MoneyManager.get()) == []
+
+    url = submit(client, report, '')
+    assert wait(client, url)['status'] == JobsManager.DONE
+    assert get_counts(client, url)['Money'] == '2'
+    assert len(list(MoneyManager.get())) == 2
+    assert os.listdir(uploads) == []
+
+
+def test_report_job_failed(app, uploads):
+    client = app.test_client()
+    url = submit(client, b'<Report', '1')
+    status = wait(client, url)
+    assert status['status'] == JobsManager.FAILED and status['error']
+    assert client.get(url).status_code == 200
+    assert client.get('/forms/report/unknown/status').status_code == 404
+    assert client.get('/forms/report/unknown').status_code == 404
+
+
+def test_stale_job(app, uploads):
+    client = app.test_client()
+    job = JobsManager.create('report')
+    assert client.get(f'/forms/report/{job}/status').get_json()['status'] == \
+        JobsManager.QUEUED
+
+    # a job lost with its process is failed once it times out
+    JobsManager.upsert({'job': job}, {
+        'status': JobsManager.RUNNING,
+        'updated': datetime.now() - JOB_TIMEOUT - timedelta(seconds=1)})
+    status = client.get(f'/forms/report/{job}/status').get_json()
+    assert status['status'] == JobsManager.FAILED and status['error']
+    assert JobsManager.find(job).status == JobsManager.FAILED
+
+
+def test_orphaned_uploads(app, uploads):
+    client = app.test_client()
+    orphan = uploads / 'orphan.xml'
+    orphan.write_bytes(b'')
+    recent = uploads / 'recent.xml'
+    recent.write_bytes(b'')
+    old = time.time() - JOB_TIMEOUT.total_seconds() - 1
+    os.utime(orphan, (old, old))
+
+    url = submit(client, get_report([get_transfer(1, 100)]), '1')
+    wait(client, url)
+    assert os.listdir(uploads) == ['recent.xml']